@@ -1,7 +1,64 @@
+from django.conf.urls import url
 from tastypie import fields
-from tastypie.resources import ModelResource
+from tastypie.exceptions import BadRequest
+from tastypie.resources import ModelResource, Resource
 from tastypie.constants import ALL, ALL_WITH_RELATIONS
+from tastypie.utils import trailing_slash
+from classify.corpus import ID_BATCH_SIZE
+from classify.model import MODEL_PATH
+from classify.predict import get_predictor
 from quotex.apps.content.models import Paragraph, Source
+from quotex.apps.content.search import get_source_search
+from quotex.apps.content.stats import get_sampler
+
+# Query parameters that don't stop a quote list from being a random sample
+SAMPLE_PARAMS = frozenset(['format', 'limit', 'offset', 'sources'])
+
+# Most paragraphs the classify endpoint scores in one request
+MAX_CLASSIFY_BATCH = 500
+
+
+class RandomQuotes(object):
+    '''
+    Stands in for a queryset of quotes when they're listed in random order.
+    Its length is the number of quotes to choose from, and any slice of it is
+    a new random sample of that many quotes, so the paginator never needs the
+    database to shuffle the whole table.
+    '''
+    def __init__(self, sampler, source=None, queryset=None):
+        self.sampler = sampler
+        self.source = source
+        self.queryset = queryset
+
+    def __len__(self):
+        return self.sampler.count(self.source)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.sampler.sample(len(xrange(*index.indices(len(self)))), self.source, self.queryset)
+        return self.sampler.sample(1, self.source, self.queryset)[0]
+
+
+class QuotesById(object):
+    '''
+    Stands in for a queryset of the quotes with the given ids, in that order.
+    Slicing it fetches just the quotes in the slice.
+    '''
+    def __init__(self, pks, queryset):
+        self.pks = pks
+        self.queryset = queryset
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        pks = self.pks[index]
+        quotes = {}
+        for start in range(0, len(pks), ID_BATCH_SIZE):
+            quotes.update(self.queryset.in_bulk(pks[start:start + ID_BATCH_SIZE]))
+        return [quotes[pk] for pk in pks if pk in quotes]
 
 
 class SourceResource(ModelResource):
@@ -20,16 +77,121 @@ class SourceResource(ModelResource):
 class QuoteResource(ModelResource):
     '''
     API resource for Paragraph objects.
+
+    Unfiltered lists, and lists filtered only by a source id (?sources=<id>),
+    come back in random order, a new sample on every request. ?search=<name>
+    lists the quotes of every source whose name matches, found through the
+    source search index. Other filters return matching quotes in story order.
+
+    /api/v1/quote/search/?q=<name> returns just the matching sources and
+    quote ids, for the search box.
+
+    Each quote's story (for its link) and sources are fetched for the whole
+    page at once, so a page costs the same few queries however long it is.
     '''
     sources = fields.ToManyField(SourceResource, 'sources')
     class Meta:
-        queryset = Paragraph.quotes.all().order_by('?')
+        queryset = Paragraph.quotes.select_related('story').prefetch_related('sources')
         fields = ['text',]
         filtering = {
             "sources": ALL_WITH_RELATIONS,
         }
 
+    def override_urls(self):
+        return [
+            url(r'^(?P<resource_name>%s)/search%s$' % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_search'), name='api_get_search'),
+        ]
+
+    def get_search(self, request, **kwargs):
+        '''
+        Returns the sources whose names match the q parameter and the ids of
+        their quotes.
+        '''
+        self.method_check(request, allowed=['get'])
+        self.throttle_check(request)
+        query = request.GET.get('q', '')
+        result = get_source_search().search(query)
+        self.log_throttled_access(request)
+        return self.create_response(request, {
+            'query': query,
+            'sources': [{'id': pk, 'name': name} for pk, name in result['sources']],
+            'quote_ids': result['quote_ids'],
+        })
+
+    def obj_get_list(self, request=None, **kwargs):
+        params = request is not None and request.GET or {}
+        if params.get('search'):
+            return QuotesById(get_source_search().search(params['search'])['quote_ids'],
+                Paragraph.objects.select_related('story').prefetch_related('sources'))
+        if not kwargs and not set(params) - SAMPLE_PARAMS:
+            source = params.get('sources')
+            if source is None or source.isdigit():
+                return RandomQuotes(get_sampler(), source and int(source),
+                    Paragraph.objects.select_related('story').prefetch_related('sources'))
+        return super(QuoteResource, self).obj_get_list(request, **kwargs)
+
     def dehydrate(self, bundle):
         # Add the story link from the related Story object
         bundle.data['link'] = bundle.obj.story.get_absolute_url()
-        return bundle
\ No newline at end of file
+        return bundle
+
+
+class ClassifyResource(Resource):
+    '''
+    Scores new text with the saved model, for flagging quotes as they're written.
+
+    GET /api/v1/classify/?text=<paragraph> scores one paragraph. POST a JSON
+    object with a "text" string to do the same, or with a "texts" list to score
+    up to MAX_CLASSIFY_BATCH paragraphs at once and get a "results" list back.
+    Each result has the guess (quote), its probability (score), the probability
+    that the paragraph is a quote and the features behind it, with the weight
+    each one adds to the log-odds. Pass explain=false to leave the features out.
+
+    The model is loaded once per process (see classify.predict) and reloaded
+    when the saved file changes.
+    '''
+    model_path = MODEL_PATH
+
+    class Meta:
+        resource_name = 'classify'
+        list_allowed_methods = ['get', 'post']
+        detail_allowed_methods = []
+
+    def override_urls(self):
+        return [
+            url(r'^(?P<resource_name>%s)%s$' % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('classify'), name='api_classify'),
+        ]
+
+    def classify(self, request, **kwargs):
+        self.method_check(request, allowed=self._meta.list_allowed_methods)
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        if request.method == 'POST':
+            data = self.deserialize(request, request.raw_post_data)
+            if not isinstance(data, dict):
+                raise BadRequest('Expected an object with "text" or "texts".')
+        else:
+            data = request.GET
+        texts = data.get('texts')
+        single = texts is None
+        if single:
+            texts = [data.get('text')]
+        if not isinstance(texts, list) or not all(isinstance(text, basestring) for text in texts):
+            raise BadRequest('"text" should be a string, or "texts" a list of strings.')
+        if len(texts) > MAX_CLASSIFY_BATCH:
+            raise BadRequest('At most %s texts can be scored at once.' % MAX_CLASSIFY_BATCH)
+        explain = unicode(data.get('explain', True)).lower() not in ('false', '0', 'no')
+
+        try:
+            predictor = get_predictor(self.model_path)
+        except (IOError, OSError, ValueError), e:
+            return self.create_response(request, {'error': 'No usable model: %s' % e}, status=503)
+        results = predictor.predict(texts, explain=explain)
+        self.log_throttled_access(request)
+        if single:
+            response = dict(results[0], model_version=predictor.version)
+        else:
+            response = {'model_version': predictor.version, 'results': results}
+        return self.create_response(request, response)
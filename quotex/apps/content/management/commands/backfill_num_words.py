@@ -0,0 +1,56 @@
+'''
+backfill_num_words.py
+
+Management command to fill in Paragraph.num_words for every paragraph.
+
+Paragraph.save keeps num_words up to date from now on, but paragraphs saved
+before that, or written in bulk, can be missing it or out of date. This
+recounts the quoted words of every paragraph a chunk at a time and writes only
+the ones that changed, with one UPDATE per distinct count in each chunk
+instead of one save per row. The Counter totals are recounted at the end.
+'''
+from __future__ import absolute_import # Otherwise classify would import the classify command
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from quotex.apps.content.models import Counter, Paragraph, count_quoted_words
+from classify.corpus import ID_BATCH_SIZE, iter_keyset
+
+# Paragraphs read and updated per transaction
+CHUNK_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Recounts the quoted words of every paragraph and saves those that changed.'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=CHUNK_SIZE,
+            help='Paragraphs updated per transaction. Defaults to %s.' % CHUNK_SIZE),
+        make_option('--missing', action='store_true', dest='missing', default=False,
+            help='Only fill in paragraphs that have no num_words yet.'),
+    )
+
+    def handle(self, *args, **options):
+        queryset = Paragraph.objects.all()
+        if options['missing']:
+            queryset = queryset.filter(num_words=None)
+
+        checked = updated = 0
+        for rows in iter_keyset(queryset.values_list('pk', 'text', 'num_words'), chunk_size=options['chunk_size']):
+            # Group the paragraphs that need updating by their new count
+            changed = {}
+            for pk, text, num_words in rows:
+                count = count_quoted_words(text)
+                if count != num_words:
+                    changed.setdefault(count, []).append(pk)
+            with transaction.commit_on_success():
+                for count, pks in changed.items():
+                    for start in range(0, len(pks), ID_BATCH_SIZE):
+                        Paragraph.objects.filter(pk__in=pks[start:start + ID_BATCH_SIZE]) \
+                            .update(num_words=count)
+
+            checked += len(rows)
+            updated += sum(len(pks) for pks in changed.values())
+
+        totals = Counter.recount()
+        self.stdout.write('Checked %s paragraphs, updated %s. %s quoted words in %s quotes.\n' % (
+            checked, updated, totals['quoted_words'], totals['quotes']))
@@ -0,0 +1,113 @@
+'''
+classify.py
+
+Management command to classify paragraphs with a saved maxent model.
+
+By default it classifies every paragraph that hasn't been classified yet. With
+--incremental it instead picks up every paragraph whose text has changed since
+it was classified or that was classified by a different model version, so
+re-running after a retrain or an editing session only touches what changed.
+
+With --context the model also uses story context features, and paragraphs are
+classified a story at a time (see classify.context).
+'''
+from __future__ import absolute_import # Otherwise classify would import this module
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from quotex.apps.content.models import Paragraph
+from classify.corpus import iter_paragraphs, iter_stories, stale_paragraphs
+from classify.instrument import SamplingProfiler, metrics
+from classify.maxent import MODEL_PATH, ContextMaxentWrapper, MaxentWrapper
+from classify.parallel import classify_parallel
+from classify.scoring import BATCH_SIZE
+from classify.store import FeatureStore
+from classify.train import ALGORITHMS
+from classify.writer import WRITE_CHUNK_SIZE, ResultWriter
+
+
+class Command(BaseCommand):
+    help = 'Classifies paragraphs as quotes or non-quotes using a saved maxent model.'
+    option_list = BaseCommand.option_list + (
+        make_option('--model', dest='model', default=MODEL_PATH,
+            help='Path of the saved model. Defaults to %s' % MODEL_PATH),
+        make_option('--train', action='store_true', dest='train', default=False,
+            help='Train a model on the training set and save it to --model first.'),
+        make_option('--algorithm', dest='algorithm', default='iis', choices=ALGORITHMS,
+            help='Training algorithm for --train: %s. Defaults to iis.' % ' or '.join(ALGORITHMS)),
+        make_option('--warm-start', action='store_true', dest='warm_start', default=False,
+            help='With --train --algorithm=lbfgs, start from the model already saved at --model.'),
+        make_option('--context', action='store_true', dest='context', default=False,
+            help='Use story context features and classify a story at a time. Needs a model trained with --context.'),
+        make_option('--incremental', action='store_true', dest='incremental', default=False,
+            help='Only classify paragraphs that are new, edited or scored by another model version.'),
+        make_option('--workers', dest='workers', type='int', default=1,
+            help='Number of worker processes. Defaults to 1.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=BATCH_SIZE,
+            help='Paragraphs scored per batch. Defaults to %s.' % BATCH_SIZE),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=WRITE_CHUNK_SIZE,
+            help='Results written per transaction. Defaults to %s.' % WRITE_CHUNK_SIZE),
+        make_option('--store', action='store_true', dest='store', default=False,
+            help='Reuse and save extracted features in the feature store.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Print results as JSON lines instead of saving them.'),
+        make_option('--metrics', dest='metrics', default=None,
+            help='Time each stage and save the timings to this path, as Prometheus text if it ends in .prom and JSON otherwise.'),
+        make_option('--profile', dest='profile', default=None,
+            help='Run a sampling profiler and save collapsed stacks to this path.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['metrics']:
+            metrics.reset()
+            metrics.enable()
+        profiler = options['profile'] and SamplingProfiler() or None
+        if profiler is not None:
+            profiler.start()
+        try:
+            self.run(**options)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                profiler.write_collapsed(options['profile'])
+            if options['metrics']:
+                metrics.write(options['metrics'])
+
+    def run(self, **options):
+        if options['context'] and options['workers'] > 1:
+            raise CommandError('--context classifies in a single process. Leave out --workers.')
+        store = None
+        if options['store'] and not options['context']:
+            store = FeatureStore(readonly=options['dry_run']) # Dry runs don't save features either
+        wrapper_class = options['context'] and ContextMaxentWrapper or MaxentWrapper
+        if options['train']:
+            training = {'algo': options['algorithm']}
+            if options['warm_start']:
+                training['warm_start'] = wrapper_class.load(options['model'])
+            if options['context']:
+                train = iter_stories(Paragraph.training.all(), Paragraph.objects.all())
+            else:
+                train = iter_paragraphs(Paragraph.training.all())
+            wrapper_class(train, store=store).fit(**training).save(options['model'])
+        wrapper = wrapper_class.load(options['model'], store=store)
+
+        if options['incremental']:
+            queryset = stale_paragraphs(Paragraph.objects.all(), wrapper.get_version())
+        else:
+            queryset = Paragraph.unclassified.all()
+
+        # Dry runs print results on stdout, so keep the progress report off it
+        report = options['dry_run'] and sys.stderr or self.stdout
+        writer = ResultWriter(chunk_size=options['chunk_size'], dry_run=options['dry_run'])
+
+        if options['workers'] > 1:
+            stats = classify_parallel(queryset, workers=options['workers'], model_path=options['model'],
+                batch_size=options['batch_size'], writer=writer, use_store=options['store'])
+            for pid, worker in sorted(stats.items()):
+                report.write('Worker %s: %s paragraphs in %.1fs (%.0f/sec)\n' % (
+                    pid, worker['paragraphs'], worker['seconds'], worker['per_second']))
+        elif options['context']:
+            wrapper.classify(iter_stories(queryset, Paragraph.objects.all()), writer=writer)
+        else:
+            wrapper.classify(iter_paragraphs(queryset), batch_size=options['batch_size'], writer=writer)
+        report.write('Classified %s paragraphs with model %s\n' % (writer.written, wrapper.get_version()))
@@ -0,0 +1,50 @@
+'''
+ingest.py
+
+Management command to split stories into paragraphs.
+
+With no arguments it splits every story in the database that has no paragraphs
+yet. Given JSON lines or CSV files, it saves each record in them as a new story
+and splits that. Records need a title and a body, and can have a slug and url.
+'''
+from __future__ import absolute_import
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from quotex.utils.ingest import CHUNK_SIZE, ingest, read_csv, read_jsonl, unsplit_stories
+
+
+class Command(BaseCommand):
+    args = '[file.jsonl|file.csv ...]'
+    help = 'Splits stories into paragraphs, from files or from stories in the database.'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='Input format, jsonl or csv. Defaults to guessing from each file name.'),
+        make_option('--workers', dest='workers', type='int', default=1,
+            help='Number of worker processes. Defaults to 1.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=CHUNK_SIZE,
+            help='Stories written per transaction. Defaults to %s.' % CHUNK_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        readers = {'jsonl': read_jsonl, 'csv': read_csv}
+        if options['format'] is not None and options['format'] not in readers:
+            raise CommandError('Unknown format: %s' % options['format'])
+
+        def stories():
+            if not args:
+                for story in unsplit_stories():
+                    yield story
+            for path in args:
+                name = options['format'] or path.rsplit('.', 1)[-1].lower()
+                if name not in readers:
+                    raise CommandError('Can\'t tell the format of %s. Use --format.' % path)
+                for story in readers[name](path):
+                    yield story
+
+        def progress(stats):
+            self.stdout.write('\r%(stories)s stories, %(paragraphs)s paragraphs (%(seconds).1fs)' % stats)
+            self.stdout.flush()
+
+        stats = ingest(stories(), workers=options['workers'], chunk_size=options['chunk_size'],
+            progress=progress)
+        self.stdout.write('\nIngested %(stories)s stories into %(paragraphs)s paragraphs in %(seconds).1fs\n' % stats)
@@ -0,0 +1,85 @@
+'''
+upgrade_schema.py
+
+Management command to add the Paragraph columns and indexes that later versions
+need to an existing database. syncdb creates new tables, like FeatureSet and
+Counter, but never alters existing ones, so run it first.
+'''
+import re
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from quotex.apps.content.models import Paragraph
+
+# Paragraph columns added since the first release. Existing rows get ''.
+NEW_COLUMNS = ('text_hash', 'model_version')
+
+# Paragraph columns indexed since the first release
+NEW_INDEXES = ('quote', 'model_version')
+
+# Name of the index a CREATE INDEX statement makes
+INDEX_NAME_RE = re.compile(r'^CREATE INDEX "?([^" ]+)"?')
+
+
+class Command(BaseCommand):
+    help = 'Adds missing Paragraph columns and indexes to an existing database. Run syncdb first.'
+    option_list = BaseCommand.option_list + (
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to upgrade. Defaults to "%s".' % DEFAULT_DB_ALIAS),
+        make_option('--sql', action='store_true', dest='sql', default=False,
+            help='Print the SQL instead of running it.'),
+    )
+
+    def handle(self, *args, **options):
+        using = options['database']
+        connection = connections[using]
+        statements = get_upgrade_sql(connection)
+        if options['sql']:
+            for sql in statements:
+                self.stdout.write(sql + ';\n')
+            return
+        with transaction.commit_on_success(using=using):
+            cursor = connection.cursor()
+            for sql in statements:
+                cursor.execute(sql)
+        self.stdout.write('Ran %s statements.\n' % len(statements))
+
+def get_upgrade_sql(connection):
+    '''
+    Returns the ALTER TABLE and CREATE INDEX statements the database is missing.
+    '''
+    qn = connection.ops.quote_name
+    opts = Paragraph._meta
+    cursor = connection.cursor()
+    columns = set(row[0] for row in connection.introspection.get_table_description(cursor, opts.db_table))
+    indexes = _get_index_names(connection, opts.db_table)
+
+    statements = []
+    for name in NEW_COLUMNS:
+        field = opts.get_field(name)
+        if field.column not in columns:
+            statements.append("ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT ''" % (
+                qn(opts.db_table), qn(field.column), field.db_type(connection=connection)))
+    for name in NEW_INDEXES:
+        for sql in connection.creation.sql_indexes_for_field(Paragraph, opts.get_field(name), no_style()):
+            if INDEX_NAME_RE.match(sql).group(1) not in indexes:
+                statements.append(sql.rstrip(';'))
+    return statements
+
+def _get_index_names(connection, table):
+    '''
+    Returns the names of a table's indexes. Django 1.4's introspection can't
+    tell which columns have an index on SQLite, so the catalog is read directly.
+    '''
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s", [table])
+    elif connection.vendor == 'postgresql':
+        cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+    elif connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+        return set(row[2] for row in cursor.fetchall())
+    else:
+        raise CommandError('upgrade_schema does not support the %s backend.' % connection.vendor)
+    return set(row[0] for row in cursor.fetchall())
@@ -1,7 +1,27 @@
-from django.db import models
+import hashlib
+from django.db import models, transaction
+from django.db.models import F, Sum
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.utils.html import strip_tags
 
 
+########## HELPER FUNCTIONS ##########
+
+def hash_text(text):
+    '''
+    Returns a SHA-1 hex digest of a paragraph's text, used to notice when text
+    has changed since it was last classified.
+    '''
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def count_quoted_words(text):
+    '''
+    Returns the number of words in a paragraph's text that fall between quote marks.
+    '''
+    from classify.features import scan_quotes
+    return scan_quotes(text).num_words
+
+
 ########## CUSTOM MANAGERS ##########
 
 # PARAGRAPHS
@@ -74,12 +94,16 @@ class Paragraph(models.Model):
     '''
     story = models.ForeignKey(Story)
     text = models.TextField()
-    quote = models.NullBooleanField(default=None)
+    quote = models.NullBooleanField(default=None, db_index=True)
     order = models.IntegerField()
     score = models.FloatField(blank=True, null=True)
     sources = models.ManyToManyField('Source')
     for_training = models.BooleanField(default=False)
     num_words = models.IntegerField(blank=True, null=True)
+    # Hash of the text as it was when last classified, and the version of the model
+    # that classified it. Used by incremental classification.
+    text_hash = models.CharField(max_length=40, blank=True, editable=False)
+    model_version = models.CharField(max_length=40, blank=True, db_index=True, editable=False)
     # Managers
     objects = models.Manager()
     quotes = QuoteManager()
@@ -89,24 +113,61 @@ class Paragraph(models.Model):
     class Meta:
         ordering = ['story', 'order',]
 
+    def __init__(self, *args, **kwargs):
+        super(Paragraph, self).__init__(*args, **kwargs)
+        # What this paragraph currently adds to the Counter totals
+        self._counted = self.pk is not None and self._get_counted() or (0, 0)
+
     def __unicode__(self):
         return '%s: %s' % (self.story, self.order)
 
+    def save(self, *args, **kwargs):
+        '''
+        Recounts num_words, so it always matches the text. If the text has been
+        edited since the paragraph was classified, also clear the model version
+        so the next incremental classification run picks it up.
+        '''
+        self.num_words = count_quoted_words(self.text)
+        if self.model_version and hash_text(self.text) != self.text_hash:
+            self.model_version = ''
+        super(Paragraph, self).save(*args, **kwargs)
+
+    def _get_counted(self):
+        '''
+        Returns the number of quotes and quoted words this paragraph adds to the
+        Counter totals. Reads fields straight from __dict__ so deferred fields
+        aren't fetched.
+        '''
+        if self.__dict__.get('quote') is True:
+            return (1, self.__dict__.get('num_words') or 0)
+        return (0, 0)
+
     def _set_num_words(self):
         '''
         Internal method used to set the num_words attribute. Basically
-        just counts up the number of words in quote marks. This should
-        probably go in a save method override.
-        '''
-        from classify.features import bracketed_find
-        num_words = 0
-        for q in bracketed_find(self.text, '"', '"'):
-            num_words += len(q.split())
-        self.num_words = num_words
+        just counts up the number of words in quote marks. save() does this
+        itself now, so this only saves.
+        '''
         self.save()
         return
 
 
+class FeatureSet(models.Model):
+    '''
+    Cached classifier features for a Paragraph, stored as JSON. An entry is only
+    valid while the paragraph's text and the feature version are the same as when
+    the features were extracted. classify.store.FeatureStore checks both and
+    replaces stale entries.
+    '''
+    paragraph = models.OneToOneField(Paragraph, primary_key=True)
+    text_hash = models.CharField(max_length=40)
+    feature_version = models.IntegerField()
+    features = models.TextField()
+
+    def __unicode__(self):
+        return unicode(self.paragraph)
+
+
 class Source(models.Model):
     '''
     Model representing sources, or the speakers of quotes, which are assigned
@@ -115,4 +176,128 @@ class Source(models.Model):
     name = models.CharField(max_length=255)
 
     def __unicode__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+
+class Counter(models.Model):
+    '''
+    Running totals of quotes, sources and quoted words for the index page, so
+    it doesn't have to count them on every request. Saving or deleting a
+    Paragraph or Source adjusts them as it happens. Writes that skip save(),
+    like bulk updates, should call Counter.adjust() or Counter.recount() when
+    they finish.
+
+    It also keeps version numbers for the set of quotes and for the sources and
+    their links to quotes. Each goes up by one whenever those change, so the
+    quote ids cached in each process by QuoteSampler and SourceSearch know when
+    to reload. They're kept here rather than in the cache so they can't be lost
+    when a cache entry is evicted.
+    '''
+    name = models.CharField(max_length=40, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    NAMES = ('quotes', 'sources', 'quoted_words')
+    VERSIONS = ('quotes_version', 'sources_version')
+
+    # Versions bumped by a change to each total
+    VERSION_OF = {'quotes': 'quotes_version', 'sources': 'sources_version'}
+
+    def __unicode__(self):
+        return '%s: %s' % (self.name, self.value)
+
+    @classmethod
+    def get_totals(cls):
+        '''
+        Returns a dict of every total, recounting them if any are missing.
+        '''
+        totals = dict(cls.objects.filter(name__in=cls.NAMES).values_list('name', 'value'))
+        if any(name not in totals for name in cls.NAMES):
+            totals = cls.recount()
+        return totals
+
+    @classmethod
+    def get_versions(cls):
+        '''
+        Returns a dict of every version number. Versions never bumped are 0.
+        '''
+        versions = dict(cls.objects.filter(name__in=cls.VERSIONS).values_list('name', 'value'))
+        return dict((name, versions.get(name, 0)) for name in cls.VERSIONS)
+
+    @classmethod
+    def recount(cls):
+        '''
+        Counts every total from scratch, saves them and returns them as a dict.
+        Every version is bumped too, since there's no telling what changed.
+        '''
+        totals = {
+            'quotes': Paragraph.quotes.count(),
+            'sources': Source.objects.count(),
+            'quoted_words': Paragraph.quotes.aggregate(Sum('num_words'))['num_words__sum'] or 0,
+        }
+        with transaction.commit_on_success():
+            for name, value in totals.items():
+                if not cls.objects.filter(name=name).update(value=value):
+                    cls.objects.create(name=name, value=value)
+            cls._bump(cls.VERSIONS)
+        cls._invalidate()
+        return totals
+
+    @classmethod
+    def adjust(cls, **deltas):
+        '''
+        Adds to or subtracts from totals in place, e.g. adjust(quotes=1), and
+        bumps the versions of the totals that changed.
+        '''
+        changed = [name for name, delta in deltas.items() if delta]
+        for name in changed:
+            cls.objects.filter(name=name).update(value=F('value') + deltas[name])
+        cls._bump([cls.VERSION_OF[name] for name in changed if name in cls.VERSION_OF])
+        if changed:
+            cls._invalidate()
+
+    @classmethod
+    def bump(cls, *names):
+        '''
+        Adds one to each named version, for changes that don't alter any total,
+        like linking a quote to another source.
+        '''
+        cls._bump(names)
+        cls._invalidate()
+
+    @classmethod
+    def _bump(cls, names):
+        for name in names:
+            if not cls.objects.filter(name=name).update(value=F('value') + 1):
+                cls.objects.create(name=name, value=1)
+
+    @staticmethod
+    def _invalidate():
+        from quotex.apps.content.stats import invalidate_stats
+        invalidate_stats()
+
+
+########## SIGNALS ##########
+
+def paragraph_saved(sender, instance, **kwargs):
+    old, instance._counted = instance._counted, instance._get_counted()
+    Counter.adjust(quotes=instance._counted[0] - old[0], quoted_words=instance._counted[1] - old[1])
+
+def paragraph_deleted(sender, instance, **kwargs):
+    Counter.adjust(quotes=-instance._counted[0], quoted_words=-instance._counted[1])
+
+def source_saved(sender, instance, created, **kwargs):
+    if created:
+        Counter.adjust(sources=1)
+
+def source_deleted(sender, instance, **kwargs):
+    Counter.adjust(sources=-1)
+
+def paragraph_sources_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        Counter.bump('sources_version')
+
+post_save.connect(paragraph_saved, sender=Paragraph)
+post_delete.connect(paragraph_deleted, sender=Paragraph)
+post_save.connect(source_saved, sender=Source)
+post_delete.connect(source_deleted, sender=Source)
+m2m_changed.connect(paragraph_sources_changed, sender=Paragraph.sources.through)
\ No newline at end of file
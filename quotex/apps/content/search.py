@@ -0,0 +1,164 @@
+'''
+search.py
+
+Source name search for the quote browser's search box. SourceSearch keeps an
+in-memory index of source names, rebuilt when the quotes or sources version in
+the Counter table changes, and maps each source to the ids of its quotes.
+'''
+import re
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left
+from quotex.apps.content.models import Paragraph, Source
+from quotex.apps.content.stats import get_stats
+from classify.lru import LRUCache
+
+# Number of distinct queries whose results are cached
+SEARCH_CACHE_SIZE = 1000
+
+# Anything that isn't a lowercase letter or digit after normalization
+NON_ALNUM_RE = re.compile(r'[^a-z0-9]+')
+
+########## HELPER FUNCTIONS ##########
+
+def normalize_name(name):
+    '''
+    Lowercases a name, strips accents and replaces punctuation and runs of
+    whitespace with single spaces, so "O'Neil-Smith, Jr." becomes "o neil smith jr".
+    '''
+    name = unicodedata.normalize('NFKD', unicode(name)).encode('ascii', 'ignore').lower()
+    return NON_ALNUM_RE.sub(' ', name).strip()
+
+def trigrams(text):
+    '''
+    Returns the set of three-character substrings of a string.
+    '''
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+########## SOURCE SEARCH ##########
+
+class SourceIndex(object):
+    '''
+    Searchable snapshot of every source name and the ids of its quotes.
+    '''
+    def __init__(self):
+        self.names = {}
+        self.grams = {}
+        for pk, name in Source.objects.values_list('pk', 'name').iterator():
+            normalized = normalize_name(name)
+            self.names[pk] = (name, normalized)
+            for gram in trigrams(normalized):
+                self.grams.setdefault(gram, []).append(pk)
+        self.words = sorted((word, pk) for pk, (name, normalized) in self.names.items()
+            for word in set(normalized.split()))
+
+        self.quotes = {}
+        links = Paragraph.sources.through.objects.filter(paragraph__quote=True) \
+            .values_list('source', 'paragraph').order_by('paragraph')
+        for source, paragraph in links.iterator():
+            self.quotes.setdefault(source, array('l')).append(paragraph)
+
+    def match_sources(self, query):
+        '''
+        Returns the ids of the sources whose normalized name contains the
+        normalized query or, for queries under three characters, has a word
+        that starts with it.
+        '''
+        query = normalize_name(query)
+        if not query:
+            return []
+        if len(query) < 3:
+            matches = set()
+            i = bisect_left(self.words, (query,))
+            while i < len(self.words) and self.words[i][0].startswith(query):
+                matches.add(self.words[i][1])
+                i += 1
+            return sorted(matches)
+
+        # Sources that have every trigram of the query, rarest first, then
+        # checked for the whole query
+        postings = sorted((self.grams.get(gram, ()) for gram in trigrams(query)), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                break
+        return sorted(pk for pk in candidates if query in self.names[pk][1])
+
+    def match_quotes(self, source_ids):
+        '''
+        Returns the sorted ids of the quotes attributed to any of the sources.
+        '''
+        quotes = set()
+        for pk in source_ids:
+            quotes.update(self.quotes.get(pk, ()))
+        return sorted(quotes)
+
+class SourceSearch(object):
+    '''
+    Answers source name queries from a SourceIndex, caching the results of
+    recent queries. The index is versioned by the quotes and sources versions
+    in the Counter table. When either goes up, one search builds a new index
+    while the others keep using the old one, then it's swapped in and the
+    cache emptied. Only the very first search has to wait for a build.
+    '''
+    def __init__(self, cache_size=SEARCH_CACHE_SIZE):
+        self.version = None
+        self.index = None
+        self.cache = LRUCache(cache_size)
+        self.lock = threading.Lock() # Guards the index, version and cache
+        self.build_lock = threading.Lock() # Held by whichever search is building an index
+
+    def get_index(self, version):
+        '''
+        Returns the current index, first building one for the given version if
+        there's none yet or if no other search is already rebuilding it.
+        '''
+        index = self.index
+        if index is not None and version == self.version:
+            return index
+        # With an old index to serve, don't wait on a build already in progress
+        if not self.build_lock.acquire(index is None):
+            return index
+        try:
+            if self.index is None or version != self.version:
+                index = SourceIndex()
+                with self.lock:
+                    self.version, self.index = version, index
+                    self.cache.clear()
+            return self.index
+        finally:
+            self.build_lock.release()
+
+    def search(self, query):
+        '''
+        Returns a dict with the matching sources, as a list of (id, name), and
+        the ids of their quotes.
+        '''
+        stats = get_stats()
+        index = self.get_index((stats['quotes_version'], stats['sources_version']))
+        key = normalize_name(query)
+        with self.lock:
+            result = index is self.index and self.cache.get(key) or None
+        if result is None:
+            source_ids = index.match_sources(key)
+            result = {
+                'sources': [(pk, index.names[pk][0]) for pk in source_ids],
+                'quote_ids': index.match_quotes(source_ids),
+            }
+            with self.lock:
+                if index is self.index: # Don't cache results from an index swapped out meanwhile
+                    self.cache.set(key, result)
+        return result
+
+_search = None
+
+def get_source_search():
+    '''
+    Returns a SourceSearch shared by this process, created the first time it's needed.
+    '''
+    global _search
+    if _search is None:
+        _search = SourceSearch()
+    return _search
@@ -0,0 +1,127 @@
+'''
+stats.py
+
+Cached site statistics and random quote sampling.
+
+The index page shows the quote, source and quoted word totals and a random
+quote. get_stats keeps the totals from the Counter model in the "stats"
+cache, so a page load doesn't touch the Paragraph table to get them.
+Counter.recount, Counter.adjust and Counter.bump call invalidate_stats, so the
+cached stats are dropped as soon as a classification run, a coref run or an
+edit changes them.
+
+Random quotes, for the index page and the quote API, come from a QuoteSampler.
+It keeps the ids of every quote in a dense array, plus arrays for recently
+sampled sources, and picks from them with random.sample, so a random quote
+costs the same however many there are. order_by('?') sorts every quote. The
+stats carry the Counter versions, and a sampler drops its arrays when the
+quotes version changes.
+'''
+import random
+import threading
+from array import array
+from django.core.cache import get_cache
+from quotex.apps.content.models import Counter, Paragraph
+from classify.corpus import ID_BATCH_SIZE
+from classify.lru import LRUCache
+
+# Cache alias, key and lifetime of the stats. Invalidation normally clears them
+# long before they expire.
+STATS_CACHE = 'stats'
+STATS_KEY = 'content:stats'
+STATS_TIMEOUT = 60 * 60
+
+# Number of sources whose quote ids a QuoteSampler keeps at once
+SAMPLER_SOURCES = 1000
+
+########## STATS ##########
+
+def get_stats():
+    '''
+    Returns a dict of the quotes, sources and quoted_words totals and the
+    quotes_version and sources_version numbers (see Counter).
+    '''
+    cache = get_cache(STATS_CACHE)
+    stats = cache.get(STATS_KEY)
+    if stats is None:
+        stats = dict(Counter.get_totals())
+        stats.update(Counter.get_versions())
+        cache.set(STATS_KEY, stats, STATS_TIMEOUT)
+    return stats
+
+def invalidate_stats():
+    '''
+    Drops the cached stats, so the next get_stats call reads them again.
+    '''
+    get_cache(STATS_CACHE).delete(STATS_KEY)
+
+########## SAMPLING ##########
+
+class QuoteSampler(object):
+    '''
+    Picks random quotes, optionally only those of one source, in constant time.
+    '''
+    def __init__(self, max_sources=SAMPLER_SOURCES):
+        self.version = None
+        self.pks = None
+        self.by_source = LRUCache(max_sources)
+        self.lock = threading.Lock()
+
+    def get_pks(self, source=None):
+        '''
+        Returns an array of the ids of every quote, or of every quote attributed
+        to a source (given by id).
+        '''
+        version = get_stats()['quotes_version']
+        with self.lock:
+            if version != self.version:
+                self.version, self.pks = version, None
+                self.by_source.clear()
+            if source is None:
+                if self.pks is None:
+                    self.pks = array('l', Paragraph.quotes.values_list('pk', flat=True).order_by())
+                return self.pks
+            pks = self.by_source.get(source)
+            if pks is None:
+                pks = array('l', Paragraph.quotes.filter(sources=source).values_list('pk', flat=True).order_by())
+                self.by_source.set(source, pks)
+            return pks
+
+    def count(self, source=None):
+        '''
+        Returns the number of quotes there are to sample from.
+        '''
+        return len(self.get_pks(source))
+
+    def sample(self, n, source=None, queryset=None):
+        '''
+        Returns up to n different random quotes, fetched from queryset
+        (Paragraph.objects with their stories by default) by id.
+        '''
+        pks = self.get_pks(source)
+        chosen = random.sample(pks, min(n, len(pks)))
+        if queryset is None:
+            queryset = Paragraph.objects.select_related('story')
+        quotes = {}
+        for start in range(0, len(chosen), ID_BATCH_SIZE):
+            quotes.update(queryset.in_bulk(chosen[start:start + ID_BATCH_SIZE]))
+        return [quotes[pk] for pk in chosen if pk in quotes]
+
+_sampler = None
+
+def get_sampler():
+    '''
+    Returns a QuoteSampler shared by this process, created the first time it's needed.
+    '''
+    global _sampler
+    if _sampler is None:
+        _sampler = QuoteSampler()
+    return _sampler
+
+def random_quote():
+    '''
+    Returns a random quote, or None if there are none.
+    '''
+    for quote in get_sampler().sample(1):
+        return quote
+    return None
@@ -0,0 +1,133 @@
+import json
+from django.test import TestCase
+from django.test.utils import override_settings
+from quotex.apps.content.models import Paragraph
+from classify.features import FeatureExtractor, StemCache, clean_text, contains_quotes, \
+    first_quote_index, last_word, num_words_between_quotes, said_near_source, words_near_quotes
+from classify.maxent import get_features
+from classify.scoring import BatchScorer
+from classify.train import ALGORITHMS, train_classifier
+
+
+# Keep the stats cache in memory, so tests don't write to quotex/data/cache
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+    'stats': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'content-tests',
+    },
+}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class QuoteResourceQueryTest(TestCase):
+    '''
+    A page of quotes should cost the same number of queries however many quotes
+    are on it: one for the quotes and their stories and one for their sources.
+    '''
+    fixtures = ['api_quotes.json']
+
+    # Queries per page once the sampler or search index is warm
+    PAGE_QUERIES = 2
+
+    def get_quotes(self, **params):
+        params['format'] = 'json'
+        response = self.client.get('/api/v1/quote/', params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['objects']
+
+    def assertPageQueries(self, limits, **params):
+        self.get_quotes(**params) # Warm the sampler or search index
+        for limit in limits:
+            with self.assertNumQueries(self.PAGE_QUERIES):
+                quotes = self.get_quotes(limit=limit, **params)
+            self.assertEqual(len(quotes), limit)
+            for quote in quotes:
+                self.assertTrue(quote['link'])
+
+    def test_random_page_queries(self):
+        self.assertPageQueries([2, 20])
+
+    def test_source_page_queries(self):
+        source = self.get_search('Esposto')['sources'][0]['id']
+        self.assertPageQueries([2, 10], sources=source)
+
+    def test_search_page_queries(self):
+        self.assertPageQueries([2, 10], search='esposto')
+
+    def get_search(self, query):
+        response = self.client.get('/api/v1/quote/search/', {'q': query, 'format': 'json'})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_search(self):
+        result = self.get_search('ken esp')
+        self.assertEqual([source['name'] for source in result['sources']], ['Ken Esposto'])
+        self.assertEqual(len(result['quote_ids']), 14)
+
+
+def get_feature_functions(words):
+    '''
+    Builds a feature dict the way maxent.get_features did before FeatureExtractor,
+    by calling each active feature function in classify.features in turn.
+    '''
+    features = {
+        'contains_quotes': contains_quotes(words),
+        'first_quote_index': first_quote_index(words),
+        'last_word_%s' % last_word(clean_text(words)): True,
+        'said_near_source': said_near_source(words),
+        'num_words_between_quotes': num_words_between_quotes(words),
+    }
+    for word in words_near_quotes(words):
+        features['%s_near_quote' % word] = True
+    return features
+
+
+@override_settings(CACHES=TEST_CACHES)
+class FeatureExtractorTest(TestCase):
+    '''
+    FeatureExtractor cleans each text once, but should build exactly the same
+    feature dicts as the individual feature functions.
+    '''
+    fixtures = ['api_quotes.json']
+
+    # Texts with odd quote marks, punctuation or no words at all
+    EDGE_CASES = [
+        '',
+        '"',
+        '" "',
+        'No quotes here, Smith said.',
+        '"Unclosed quote that runs on, he said',
+        '"One," she said. "Two." "Three" and "four',
+        '...   !!! ,,,',
+    ]
+
+    def test_matches_feature_functions(self):
+        extractor = FeatureExtractor(cache=StemCache())
+        texts = list(Paragraph.objects.values_list('text', flat=True)) + self.EDGE_CASES
+        for text in texts:
+            self.assertEqual(extractor.extract(text), get_feature_functions(text), text)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BatchScorerTest(TestCase):
+    '''
+    BatchScorer should give the same guesses and certainties as NLTK's
+    prob_classify, for models from every supported training algorithm.
+    '''
+    fixtures = ['api_quotes.json']
+
+    def test_matches_prob_classify(self):
+        paragraphs = list(Paragraph.objects.order_by('pk'))
+        featuresets = [get_features(p.text) for p in paragraphs]
+        # Train on half, so the other half has features the model hasn't seen
+        train_set = zip(featuresets, [p.quote for p in paragraphs])[::2]
+        for algo in ALGORITHMS:
+            classifier, history = train_classifier(train_set, algo=algo, max_iter=5)
+            scored = BatchScorer(classifier).score(featuresets)
+            for featureset, (guess, certainty) in zip(featuresets, scored):
+                dist = classifier.prob_classify(featureset)
+                self.assertEqual(guess, dist.max(), algo)
+                self.assertAlmostEqual(certainty, dist.prob(dist.max()), 6, algo)
@@ -1,6 +1,5 @@
 from django.views.generic import TemplateView
-from django.db.models import Sum
-from quotex.apps.content.models import Paragraph, Source
+from quotex.apps.content.stats import get_stats, random_quote
 
 
 class IndexView(TemplateView):
@@ -14,8 +13,9 @@ class IndexView(TemplateView):
         Extra context.
         '''
         context = super(IndexView, self).get_context_data(**kwargs)
-        context['initial_quote'] = Paragraph.quotes.all().order_by('?')[0]
-        context['quotes_count'] = Paragraph.quotes.all().count()
-        context['sources_count'] = Source.objects.all().count()
-        context['quoted_words_count'] = Paragraph.quotes.all().aggregate(Sum('num_words'))['num_words__sum']
+        stats = get_stats()
+        context['initial_quote'] = random_quote()
+        context['quotes_count'] = stats['quotes']
+        context['sources_count'] = stats['sources']
+        context['quoted_words_count'] = stats['quoted_words']
         return context
\ No newline at end of file
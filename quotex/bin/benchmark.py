@@ -0,0 +1,278 @@
+'''
+benchmark.py
+
+Throughput benchmarks for the classification and coref pipeline.
+
+Runs against a temporary copy of the bundled SQLite database, so nothing in
+quotex/data is changed, and prints results as JSON so runs on different
+commits can be compared. It measures:
+
+* features: paragraphs per second through get_features
+* train: seconds to train MaxentWrapper on the training set, with IIS and L-BFGS
+* score: paragraphs per second through BatchScorer, given their features
+* write: results per second written back by ResultWriter
+* coref: stories per second through resolve_paragraphs, using the offline
+  LocalBackend in place of Calais so no network calls are made
+
+Everything but train is also run on synthetic corpora 10 and 100 times the size
+of the bundled one (see --scales). Each copy of a story gets the same
+paragraphs with their words shuffled by a seeded random number generator, so
+runs are reproducible and the copies don't just hit the caches.
+
+Usage: python quotex/bin/benchmark.py [options]
+'''
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+# Run as a script, so put the repository root on the path for quotex.settings
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quotex.settings')
+
+from django.conf import settings
+
+# Synthetic corpus sizes, as multiples of the bundled corpus
+SCALES = (1, 10, 100)
+
+# Times each repeatable benchmark is run. The fastest run is reported.
+REPEAT = 3
+
+# Stories copied per transaction when building a synthetic corpus
+COPY_CHUNK_SIZE = 100
+
+########## SETUP ##########
+
+def _use_temporary_database():
+    '''
+    Points Django at a temporary copy of the database and an in-memory cache.
+    Has to run before anything opens a connection or imports the cache.
+    Returns the temporary directory, for cleanup.
+    '''
+    database = settings.DATABASES['default']
+    if database['ENGINE'] != 'django.db.backends.sqlite3':
+        raise SystemExit('Benchmarks only run against the SQLite database.')
+    directory = tempfile.mkdtemp(prefix='quotex-benchmark-')
+    copy = os.path.join(directory, 'quotex')
+    shutil.copyfile(database['NAME'], copy)
+    database['NAME'] = copy
+    settings.CACHES['stats'] = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    settings.DEBUG = False # Otherwise every query is kept in memory
+    return directory
+
+def _train_model():
+    '''
+    Returns a MaxentWrapper trained once with L-BFGS, for the score and write
+    benchmarks when train isn't run.
+    '''
+    from classify.corpus import iter_paragraphs
+    from classify.maxent import MaxentWrapper
+    from quotex.apps.content.models import Paragraph
+    return MaxentWrapper(iter_paragraphs(Paragraph.training.all())).fit(algo='lbfgs')
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _result(name, scale, items, seconds, runs=None):
+    result = {
+        'benchmark': name,
+        'scale': scale,
+        'items': items,
+        'seconds': seconds,
+        'per_second': items / seconds if seconds else None,
+    }
+    if runs is not None:
+        result['runs'] = runs
+    return result
+
+########## SYNTHETIC CORPUS ##########
+
+def grow_corpus(stories, copies, first_copy, rng):
+    '''
+    Adds copies of the given (story, paragraphs) pairs to the database, with
+    each paragraph's words shuffled. first_copy numbers the copies, so growing
+    a corpus twice doesn't repeat them.
+    '''
+    from django.db import transaction
+    from quotex.apps.content.models import Paragraph, Story
+    for copy in range(first_copy, first_copy + copies):
+        for start in range(0, len(stories), COPY_CHUNK_SIZE):
+            with transaction.commit_on_success():
+                paragraphs = []
+                for story, texts in stories[start:start + COPY_CHUNK_SIZE]:
+                    new = Story.objects.create(title='%s (copy %s)' % (story.title, copy), url=story.url)
+                    for order, text, num_words in texts:
+                        words = text.split()
+                        rng.shuffle(words)
+                        paragraphs.append(Paragraph(story=new, order=order, text=' '.join(words),
+                            num_words=num_words))
+                for i in range(0, len(paragraphs), 100):
+                    Paragraph.objects.bulk_create(paragraphs[i:i + 100])
+
+########## BENCHMARKS ##########
+
+def bench_features(scale, repeat):
+    from classify.corpus import iter_paragraphs
+    from classify.features import stem_cache
+    from classify.maxent import get_features
+    from quotex.apps.content.models import Paragraph
+    texts = [row.text for row in iter_paragraphs(Paragraph.objects.all())]
+    runs = []
+    for i in range(repeat):
+        stem_cache.clear()
+        start = time.time()
+        for text in texts:
+            get_features(text)
+        runs.append(time.time() - start)
+    return _result('features', scale, len(texts), min(runs), runs)
+
+def bench_train(repeat):
+    from classify.corpus import iter_paragraphs
+    from classify.maxent import MaxentWrapper
+    from quotex.apps.content.models import Paragraph
+    items = list(iter_paragraphs(Paragraph.training.all()))
+    results, wrapper = [], None
+    for algo in ('iis', 'lbfgs'):
+        runs = []
+        for i in range(repeat):
+            wrapper = MaxentWrapper(items)
+            start = time.time()
+            wrapper.fit(algo=algo)
+            runs.append(time.time() - start)
+        results.append(_result('train.%s' % algo, 1, len(items), min(runs), runs))
+    return results, wrapper
+
+def bench_score(scale, repeat, wrapper):
+    from classify.corpus import iter_paragraphs
+    from classify.scoring import BATCH_SIZE, iter_batches
+    from quotex.apps.content.models import Paragraph
+    scorer = wrapper.get_scorer()
+    batches = [(batch, wrapper.get_featuresets(batch))
+        for batch in iter_batches(iter_paragraphs(Paragraph.objects.all()), BATCH_SIZE)]
+    runs = []
+    for i in range(repeat):
+        scored = []
+        start = time.time()
+        for batch, featuresets in batches:
+            scored.extend(zip(batch, scorer.score(featuresets)))
+        runs.append(time.time() - start)
+    return _result('score', scale, len(scored), min(runs), runs), scored
+
+def bench_write(scale, scored, version):
+    from classify.writer import ResultWriter
+    from quotex.apps.content.models import hash_text
+    writer = ResultWriter()
+    start = time.time()
+    for row, (guess, certainty) in scored:
+        writer.add(row.pk, guess, certainty, hash_text(row.text), version)
+    writer.close()
+    return _result('write', scale, writer.written, time.time() - start)
+
+def bench_coref(scale):
+    from classify.corpus import iter_stories
+    from quotex.apps.content.models import Paragraph
+    from quotex.bin.coref import resolve_paragraphs, update_counter
+    from quotex.bin.entities import ExtractionRunner, LocalBackend
+    runner = ExtractionRunner(LocalBackend(), workers=1)
+    stories = sources = links = 0
+    start = time.time()
+    for story in iter_stories(Paragraph.objects.all()):
+        created = resolve_paragraphs(story.rows, runner=runner, update=False)
+        sources, links, stories = sources + created[0], links + created[1], stories + 1
+    update_counter(sources, links)
+    return _result('coref', scale, stories, time.time() - start)
+
+########## MAIN ##########
+
+def run(scales=SCALES, repeat=REPEAT, only=None, progress=None):
+    '''
+    Runs the benchmarks and returns a dict of results and details of the run.
+    only, if given, is a collection of benchmark names to run.
+    '''
+    from quotex.apps.content.models import Story
+
+    def wanted(name):
+        return only is None or name in only
+
+    def report(result):
+        results.append(result)
+        if progress is not None:
+            progress(result)
+
+    results = []
+    rng = random.Random(0)
+    originals = [(story, [(p.order, p.text, p.num_words) for p in story.paragraph_set.all()])
+        for story in Story.objects.all()]
+
+    wrapper = None
+    if wanted('train'):
+        train_results, wrapper = bench_train(repeat)
+        for result in train_results:
+            report(result)
+    if wrapper is None and (wanted('score') or wanted('write')):
+        wrapper = _train_model()
+
+    size = 1
+    for scale in sorted(scales):
+        grow_corpus(originals, scale - size, size, rng)
+        size = scale
+        if wanted('features'):
+            report(bench_features(scale, repeat))
+        if wanted('score') or wanted('write'):
+            result, scored = bench_score(scale, repeat, wrapper)
+            if wanted('score'):
+                report(result)
+            if wanted('write'):
+                report(bench_write(scale, scored, wrapper.get_version()))
+        if wanted('coref'):
+            report(bench_coref(scale))
+
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+        'results': results,
+    }
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--scales', dest='scales', default=','.join(str(s) for s in SCALES),
+        help='Comma-separated corpus sizes, as multiples of the bundled corpus. Defaults to %s.' % (
+            ','.join(str(s) for s in SCALES)))
+    parser.add_option('--repeat', dest='repeat', type='int', default=REPEAT,
+        help='Runs of each repeatable benchmark. The fastest is reported. Defaults to %s.' % REPEAT)
+    parser.add_option('--only', dest='only', default=None,
+        help='Comma-separated benchmarks to run: features, train, score, write, coref. Defaults to all.')
+    parser.add_option('--output', dest='output', default=None,
+        help='Save the JSON results to this path instead of printing them.')
+    options, args = parser.parse_args()
+
+    directory = _use_temporary_database()
+    try:
+        def progress(result):
+            print >> sys.stderr, '%(benchmark)s x%(scale)s: %(items)s in %(seconds).3fs' % result
+        report = run(scales=[int(s) for s in options.scales.split(',')], repeat=options.repeat,
+            only=options.only and set(options.only.split(',')) or None, progress=progress)
+    finally:
+        shutil.rmtree(directory)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
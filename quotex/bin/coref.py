@@ -11,55 +11,112 @@ ain't free: http://www.ldc.upenn.edu/Catalog/catalogEntry.jsp?catalogId=LDC2003T
 
 Calais was the cheap and easy way to start, which works fine for demo purposes.
 '''
-from calais import Calais
-from quotex.apps.content.models import Story, Source
+import sys
+from bisect import bisect_right
+from optparse import OptionParser
+from quotex.apps.content.models import Counter, Paragraph, Story, Source
+from classify.corpus import STORY_CHUNK_SIZE, iter_stories
+from classify.instrument import SamplingProfiler, metrics
+from classify.scoring import iter_batches
+from quotex.bin.entities import (BACKOFF, RETRIES, WORKERS, CalaisBackend, ExtractionRunner,
+    LocalBackend, ResponseCache)
 
 # OpenCalais API key. Get one here: http://www.opencalais.com/APIkey/
 API_KEY = ''
 
 ########## PRIVATE FUNCTIONS ##########
 
-def _get_people(text):
+def _get_runner(backend='calais', workers=WORKERS, cache=True):
     '''
-    Runs input text through Calais to extract people, coreferences and their
-    locations.
-
-    This function returns a canonical name for any given source in the document
-    and contextual information about where coreferences appear, based on the
-    text before and after the pronoun occurrance.
-
-    Takes full story text as input.
-
-    This is a pretty bare-bones function. It doesn't handle Calais API errors, so 
-    it tends to crap out from time to time. Future refinements should account for this.
+    Returns an ExtractionRunner for the named backend, caching responses on disk
+    unless cache is False.
     '''
-    # Run input text through Calais
-    calais = Calais(API_KEY, submitter="tbc-coref-test")
-    annotations = calais.analyze(text)
+    if backend == 'local':
+        entities = LocalBackend()
+    else:
+        entities = CalaisBackend(API_KEY)
+    return ExtractionRunner(entities, cache=cache and ResponseCache() or None, workers=workers,
+        retries=RETRIES, backoff=BACKOFF)
+
+def _get_people(text, runner=None):
+    '''
+    Extracts people, coreferences and their locations from a story's full text.
 
-    # If no entities come back, peace out
-    if not hasattr(annotations, 'entities'):
-        return False
+    Returns a dict mapping the canonical name of each source in the document to
+    an (exact, suffix, prefix, offset) tuple for every reference to them. The
+    work is done by an ExtractionRunner (see entities.py), which retries failed
+    Calais calls and caches responses by text, so unchanged stories are only
+    ever sent once.
+    '''
+    runner = runner or _get_runner()
+    return runner.get_people(text)
 
-    coref = {} # Dictionary to hold our corefence object.
-    for e in annotations.entities:
-        instances = []
-        # We only care about Person entities, not companies, places, etc.
-        if e['_type'] == 'Person':
-            # For each instance of that entity (which includes pronouns and other references) ...
-            for i in e['instances']:
-                # Collect the coreference text (exact) the preceding text (prefix) and the
-                # following text (suffix) for reference information. We'll need this later.
-                instances.append((i.get('exact'), i.get('suffix', ''), i.get('prefix', '')))
-            # Associate the canonical name with the coreference and context information gathered
-            # above for use later.
-            name = e.get("commonname", e.get('name', None))
-            coref[name] = instances
-    return coref
+def _index_paragraphs(paragraphs):
+    '''
+    Returns the full story text, built the same way as Story.get_fulltext(), and
+    the character offset in that text where each paragraph starts.
+    '''
+    joined = '\n'.join([p.text for p in paragraphs])
+    fulltext = joined.strip()
+    position = len(joined.lstrip()) - len(joined) # Shift from stripping leading whitespace
+    starts = []
+    for p in paragraphs:
+        starts.append(position)
+        position += len(p.text) + 1
+    return fulltext, starts
+
+def _find_paragraphs(instance, paragraphs, starts):
+    '''
+    Returns the indexes of the paragraphs a Calais instance refers to. Instances
+    with an offset are placed in their paragraph with a binary search over the
+    paragraph start offsets. Otherwise, fall back to finding paragraphs that
+    contain the text around the reference.
+    '''
+    pronoun, suffix, prefix, offset = instance
+    if offset is not None:
+        index = bisect_right(starts, int(offset)) - 1
+        return index >= 0 and [index] or []
+    return [n for n, p in enumerate(paragraphs)
+        if (suffix and p.text.find(suffix) > -1) or (prefix and p.text.find(prefix) > -1)]
+
+def _save_links(paragraphs, links):
+    '''
+    Saves a set of (source name, paragraph id) links found in a story, creating
+    sources that don't exist yet and skipping links that already do. Returns the
+    number of sources and links created, for update_counter.
+    '''
+    # Get or create a source object for everyone who was found, in bulk
+    names = set(name for name, pk in links)
+    sources = dict(Source.objects.filter(name__in=names).values_list('name', 'pk'))
+    missing = [Source(name=name) for name in names if name not in sources]
+    if missing:
+        Source.objects.bulk_create(missing)
+        sources = dict(Source.objects.filter(name__in=names).values_list('name', 'pk'))
+
+    # Assign the sources to their paragraphs, skipping links that already exist
+    through = Paragraph.sources.through
+    pairs = set((pk, sources[name]) for name, pk in links)
+    existing = set(through.objects.filter(paragraph__in=[p.pk for p in paragraphs]) \
+        .values_list('paragraph', 'source'))
+    new_pairs = pairs - existing
+    through.objects.bulk_create([through(paragraph_id=paragraph_id, source_id=source_id)
+        for paragraph_id, source_id in new_pairs])
+    return len(missing), len(new_pairs)
 
 ########## PUBLIC FUNCTIONS ##########
 
-def resolve_pronouns(story):
+def update_counter(sources, links):
+    '''
+    Adds sources created by coref to the source total, and bumps the sources
+    version if any links were made, so the search index and quote samplers
+    reload. bulk_create skips the signals that would otherwise do this.
+    '''
+    if sources:
+        Counter.adjust(sources=sources)
+    elif links:
+        Counter.bump('sources_version')
+
+def resolve_pronouns(story, people=None, runner=None, update=True):
     '''
     Function to resolve pronouns given our particularly funky use case.
 
@@ -67,36 +124,94 @@ def resolve_pronouns(story):
     paragraph objects that make up that text. It's set up this way because our system's
     main unit of content is the paragraph, not the story.
 
-    These nested loops are an awfully inefficient way of resolving pronouns. Would be great
-    to see it cleaned up. But again, for demo purposes, works just fine.
+    The story's paragraphs are loaded once and indexed by character offset, so every
+    reference Calais returns can be placed in its paragraph without scanning them all.
+    Sources and paragraph-source links are then written in bulk for the whole story.
+
+    Takes the story's people dict from _get_people if it has already been
+    extracted, or extracts it with runner. Returns the number of sources and
+    links created. With update=False, the Counter table is left alone, so a run
+    over many stories can call update_counter once at the end.
     '''
+    with metrics.timer('coref.query'):
+        paragraphs = list(story.paragraph_set.all())
+    return resolve_paragraphs(paragraphs, people, runner, update)
+
+def resolve_paragraphs(paragraphs, people=None, runner=None, update=True):
+    '''
+    Does the work of resolve_pronouns, given a story's paragraphs in order as
+    Paragraphs or as the ParagraphRows from classify.corpus.iter_stories.
+    '''
+    fulltext, starts = _index_paragraphs(paragraphs)
+
     # Get the people dict using the private function above, given the full text of the story.
-    people = _get_people(story.get_fulltext())
+    if people is None:
+        with metrics.timer('coref.extract'):
+            people = _get_people(fulltext, runner)
 
     # If no entities come back, fail silently. This almost never happens.
     if not people:
-        return
-
-    # For each person in the story ...
-    for p in people.keys():
-        canonical_name = p # The canonical name is the key
-        # For each reference to that person (last name, pronoun, whatever) ...
-        for i in people[p]:
-            # Loop through each paragraph and see if we can find the prefix and suffix
-            for paragraph in story.paragraph_set.all():
-                pronoun, suffix, prefix = i # Unpack
-                # If we find the prefix and suffix in a paragraph, either get or create a
-                # source object and assign it to that paragraph.
-                if paragraph.text.find(suffix) > -1 or paragraph.text.find(prefix) > -1:
-                    source, created = Source.objects.get_or_create(name=canonical_name)
-                    paragraph.sources.add(source)
-                    source.save()
-                    paragraph.save()
-    return
+        return 0, 0
+
+    # Work out which paragraphs each person is referenced in (last name, pronoun, whatever)
+    links = set()
+    with metrics.timer('coref.assign'):
+        for canonical_name, instances in people.items():
+            for instance in instances:
+                for index in _find_paragraphs(instance, paragraphs, starts):
+                    links.add((canonical_name, paragraphs[index].pk))
+    if not links:
+        return 0, 0
+    metrics.count('coref_links', len(links))
+    with metrics.timer('coref.write'):
+        created = _save_links(paragraphs, links)
+    if update:
+        update_counter(*created)
+    return created
 
 ########## MAIN ##########
 
 if __name__ == '__main__':
-    for s in Story.objects.all():
-        print '%s -> %s' % (s.pk, s.title)
-        resolve_pronouns(s)
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--backend', dest='backend', default='calais',
+        help='Entity extraction backend: calais or local. Defaults to calais.')
+    parser.add_option('--workers', dest='workers', type='int', default=WORKERS,
+        help='Concurrent extraction calls. Defaults to %s.' % WORKERS)
+    parser.add_option('--no-cache', action='store_false', dest='cache', default=True,
+        help='Ignore and don\'t save cached responses.')
+    parser.add_option('--metrics', dest='metrics', default=None,
+        help='Time each stage and save the timings to this path (.prom for Prometheus text, JSON otherwise).')
+    parser.add_option('--profile', dest='profile', default=None,
+        help='Run a sampling profiler and save collapsed stacks to this path.')
+    options, args = parser.parse_args()
+    if options.metrics:
+        metrics.enable()
+    profiler = options.profile and SamplingProfiler() or None
+    if profiler is not None:
+        profiler.start()
+
+    # Stream stories a chunk at a time, with their paragraphs. Extract entities for
+    # each chunk, several stories at a time, then assign them.
+    runner = _get_runner(options.backend, options.workers, options.cache)
+    sources = links = 0
+    for chunk in iter_batches(iter_stories(Paragraph.objects.all()), STORY_CHUNK_SIZE):
+        titles = dict(Story.objects.filter(pk__in=[s.story for s in chunk]).values_list('pk', 'title'))
+        with metrics.timer('coref.extract'):
+            results = runner.map([_index_paragraphs(s.rows)[0] for s in chunk])
+        for s, people in zip(chunk, results):
+            print '%s -> %s' % (s.story, titles[s.story])
+            if people is None:
+                print >> sys.stderr, 'Entity extraction failed for story %s' % s.story
+                continue
+            created = resolve_paragraphs(s.rows, people, update=False)
+            sources, links = sources + created[0], links + created[1]
+    update_counter(sources, links)
+    print '%s backend calls, %s cached responses' % (runner.calls, runner.hits)
+
+    if profiler is not None:
+        profiler.stop()
+        profiler.write_collapsed(options.profile)
+    if options.metrics:
+        metrics.count('backend_calls', runner.calls)
+        metrics.count('cached_responses', runner.hits)
+        metrics.write(options.metrics)
@@ -0,0 +1,227 @@
+'''
+entities.py
+
+Person and coreference extraction for coref.py. ExtractionRunner sends stories
+to a backend from a pool of threads, retries failed calls and caches responses
+on disk. Backends are CalaisBackend, for OpenCalais, and the offline LocalBackend.
+'''
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+# Directory for cached responses
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'entities')
+
+# Defaults for ExtractionRunner
+WORKERS = 4
+RETRIES = 3
+BACKOFF = 1.0
+
+# Characters of context kept on each side of a reference, as Calais does
+CONTEXT_LENGTH = 30
+
+########## BACKENDS ##########
+
+class EntityBackend(object):
+    '''
+    Interface for entity extraction backends. Subclasses set a name, which
+    keeps their cached responses apart, and implement get_people.
+    '''
+    name = None
+
+    def get_people(self, text):
+        '''
+        Returns a dict of {canonical name: [(exact, suffix, prefix, offset), ...]}
+        for the people referenced in text.
+        '''
+        raise NotImplementedError
+
+class CalaisBackend(EntityBackend):
+    '''
+    Extracts people and their coreferences with OpenCalais.
+    '''
+    name = 'calais'
+
+    def __init__(self, api_key, submitter='tbc-coref-test'):
+        from calais import Calais # Only needed for this backend
+        self.calais = Calais(api_key, submitter=submitter)
+
+    def get_people(self, text):
+        annotations = self.calais.analyze(text)
+
+        # If no entities come back, peace out
+        if not hasattr(annotations, 'entities'):
+            return {}
+
+        coref = {}
+        for e in annotations.entities:
+            # We only care about Person entities, not companies, places, etc.
+            if e['_type'] != 'Person':
+                continue
+            # Collect the coreference text (exact) the preceding text (prefix) and the
+            # following text (suffix) for every reference to the person, plus its
+            # character offset in the text.
+            name = e.get('commonname', e.get('name', None))
+            coref[name] = [(i.get('exact'), i.get('suffix', ''), i.get('prefix', ''), i.get('offset'))
+                for i in e['instances']]
+        return coref
+
+class LocalBackend(EntityBackend):
+    '''
+    Offline stand-in for Calais. Runs of two or more capitalized words are taken
+    to be full names. Later mentions of a known last name, and personal pronouns,
+    are attributed to the matching or most recently mentioned person.
+
+    Much cruder than a real NER system, but it needs no network access or
+    trained models and returns results in the same shape as CalaisBackend.
+    '''
+    name = 'local'
+
+    NAME_RE = re.compile(r"\b[A-Z][a-z]+(?:\s+(?:[A-Z]\.\s+)?[A-Z][a-z'-]+)+\b")
+    WORD_RE = re.compile(r"\b[A-Za-z][a-z'-]*\b")
+    PRONOUNS = frozenset(['he', 'she', 'him', 'her', 'his', 'hers'])
+
+    # Capitalized words that start runs of capitalized words but aren't names
+    NOT_NAMES = frozenset(['The', 'A', 'An', 'In', 'On', 'At', 'But', 'And', 'If', 'When',
+        'Mr', 'Mrs', 'Ms', 'Dr', 'Sen', 'Rep', 'Gov', 'President', 'Mayor'])
+
+    def get_people(self, text):
+        # Full names, keyed by where they start
+        names = {}
+        for match in self.NAME_RE.finditer(text):
+            rest = match.group()
+            while rest.split()[0].rstrip('.') in self.NOT_NAMES and len(rest.split()) > 1:
+                rest = rest[len(rest.split()[0]):].lstrip()
+            if len(rest.split()) > 1:
+                names[match.end() - len(rest)] = (' '.join(rest.split()), len(rest))
+
+        coref, last_names, current, skip = {}, {}, None, 0
+        for match in self.WORD_RE.finditer(text):
+            start, word = match.start(), match.group()
+            if start < skip: # Rest of a full name that's already been counted
+                continue
+            if start in names:
+                current, length = names[start]
+                last_names[current.split()[-1]] = current
+                skip = start + length
+            elif word in last_names:
+                current, length = last_names[word], len(word)
+            elif word.lower() in self.PRONOUNS and current is not None:
+                length = len(word)
+            else:
+                continue
+            end = start + length
+            coref.setdefault(current, []).append((text[start:end], text[end:end + CONTEXT_LENGTH],
+                text[max(start - CONTEXT_LENGTH, 0):start], start))
+        return coref
+
+########## CACHE ##########
+
+class ResponseCache(object):
+    '''
+    Stores backend responses as JSON files in a directory, one per story text
+    and backend, named by a hash of both.
+    '''
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, backend, text):
+        key = hashlib.sha1(backend.name + '\0' + text.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, backend, text):
+        try:
+            with open(self._path(backend, text)) as f:
+                people = json.load(f)
+        except (IOError, ValueError):
+            return None
+        return dict((name, [tuple(i) for i in instances]) for name, instances in people.items())
+
+    def set(self, backend, text, people):
+        path = self._path(backend, text)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError: # Another thread got there first
+                pass
+        # Write to a temporary file and rename it, so readers never see half a response
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(people, f)
+        os.rename(tmp, path)
+
+########## RUNNER ##########
+
+class ExtractionRunner(object):
+    '''
+    Runs texts through a backend with at most workers calls in flight at once,
+    retrying failed calls up to retries times and waiting backoff, 2 * backoff,
+    4 * backoff ... seconds between attempts. Texts whose response is already
+    in the cache, if one is given, don't reach the backend at all.
+    '''
+    def __init__(self, backend, cache=None, workers=WORKERS, retries=RETRIES, backoff=BACKOFF):
+        self.backend = backend
+        self.cache = cache
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.calls = 0
+        self.hits = 0
+        self.lock = threading.Lock() # Guards calls and hits, which pool threads update
+
+    def get_people(self, text):
+        '''
+        Returns the people dict for a single text.
+        '''
+        if self.cache is not None:
+            people = self.cache.get(self.backend, text)
+            if people is not None:
+                with self.lock:
+                    self.hits += 1
+                return people
+
+        attempt = 0
+        while True:
+            with self.lock:
+                self.calls += 1
+            try:
+                people = self.backend.get_people(text)
+                break
+            except Exception:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+        if self.cache is not None:
+            self.cache.set(self.backend, text, people)
+        return people
+
+    def map(self, texts):
+        '''
+        Returns the people dicts for a list of texts, in the same order. Texts
+        that still fail after every retry get None, and the error is reported
+        on stderr.
+        '''
+        def extract(text):
+            try:
+                return self.get_people(text)
+            except Exception:
+                print >> sys.stderr, 'Entity extraction failed:\n%s' % traceback.format_exc().rstrip()
+                return None
+
+        if self.workers <= 1:
+            return map(extract, texts)
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(extract, texts)
+        finally:
+            pool.close()
+            pool.join()
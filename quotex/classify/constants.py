@@ -4,8 +4,22 @@ constants.py
 Various constants that are useful in feature extraction.
 '''
 
+# Version of the feature dicts produced by classify.features. Bump this whenever a
+# change alters those dicts, so saved models built on the old ones are rejected.
+FEATURE_VERSION = 1
+
+# Version of the story context features added by classify.context. Bump it
+# whenever they change, for the same reason.
+CONTEXT_VERSION = 1
+
 PUNCTUATION_TO_REMOVE = ['.', ',', '!', '?']
 
 ATTRIBUTION_WORDS_STEMMED = ['said', 'say', 'call', 'accus', 'tell', 'told', 'report', 'assur']
 
-PRONOUNS = ['he', 'she']
\ No newline at end of file
+PRONOUNS = ['he', 'she']
+
+# Upper bound on the number of distinct words kept in the shared stem cache
+STEM_CACHE_SIZE = 50000
+
+# Number of recent texts whose quote scans are kept by classify.features.scan_quotes
+QUOTE_SCAN_CACHE_SIZE = 256
\ No newline at end of file
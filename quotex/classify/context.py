@@ -0,0 +1,211 @@
+'''
+context.py
+
+Story context features and sequence decoding.
+
+Quotes come in runs. A quote that goes on for several paragraphs leaves the
+closing mark off all but the last, and the speaker is usually named in the
+paragraph before or after. The features in classify.features only look at one
+paragraph. story_features takes every paragraph of a story, in order, and in
+one sweep adds each one's position in the story, whether its neighbors contain
+quotes or attribution words, whether the paragraph before it left a quote open
+and how many paragraphs before it attribute something.
+
+A context model also learns from whether the previous paragraph is a quote.
+In training that comes from the labels. When classifying, it depends on what
+was decided for the previous paragraph, so SequenceDecoder scores every
+paragraph both ways and picks the most probable sequence of labels for the
+whole story with the Viterbi algorithm, rather than deciding each paragraph
+on its own.
+
+Like classify.features, this needs no Django. classify.corpus.iter_stories
+loads stories for it a chunk at a time, and ContextMaxentWrapper in
+classify.maxent trains, evaluates and classifies with it.
+'''
+import random
+import numpy
+from classify.constants import ATTRIBUTION_WORDS_STEMMED
+from classify.evaluation import CALIBRATION_BINS, run_folds
+from classify.features import get_extractor, scan_quotes
+from classify.scoring import BatchScorer
+from classify.train import train_classifier
+
+# Paragraphs further than this from the start or end of a story share a position feature
+MAX_POSITION = 5
+
+# Paragraphs with more attributions before them than this share a feature
+MAX_ATTRIBUTIONS = 3
+
+# Value of the previous_quote feature for the first paragraph of a story
+START = 'start'
+
+# Floor for probabilities before taking logs, so a zero doesn't rule a path out entirely
+MIN_PROBABILITY = 1e-300
+
+ATTRIBUTION_WORDS = frozenset(ATTRIBUTION_WORDS_STEMMED)
+
+########## FEATURES ##########
+
+def story_features(texts, extractor=None):
+    '''
+    Returns a feature dict for each paragraph of a story, given as a list of
+    texts in story order. Each has the paragraph's own features plus its
+    context, but not previous_quote, which is added by label_featuresets in
+    training and by SequenceDecoder when classifying.
+    '''
+    extractor = extractor or get_extractor()
+    paragraphs = []
+    for text in texts:
+        features, tokens = extractor.analyze(text)
+        attributed = any(token.lower() in ATTRIBUTION_WORDS for token in tokens)
+        left_open = len(scan_quotes(text).marks) % 2 == 1
+        paragraphs.append((features, attributed, left_open))
+
+    last, attributions = len(paragraphs) - 1, 0
+    for i, (features, attributed, left_open) in enumerate(paragraphs):
+        features['position'] = min(i, MAX_POSITION)
+        features['position_from_end'] = min(last - i, MAX_POSITION)
+        features['contains_attribution'] = attributed
+        features['attributions_before'] = min(attributions, MAX_ATTRIBUTIONS)
+        if i > 0:
+            previous = paragraphs[i - 1]
+            features['previous_contains_quotes'] = previous[0]['contains_quotes']
+            features['previous_attribution'] = previous[1]
+            features['continues_quote'] = previous[2]
+        if i < last:
+            following = paragraphs[i + 1]
+            features['next_contains_quotes'] = following[0]['contains_quotes']
+            features['next_attribution'] = following[1]
+        attributions += attributed
+    return [features for features, attributed, left_open in paragraphs]
+
+def add_previous(featureset, previous):
+    '''
+    Returns a copy of a feature dict with previous_quote set to the label of
+    the previous paragraph, or START for the first paragraph.
+    '''
+    featureset = dict(featureset)
+    featureset['previous_quote'] = previous
+    return featureset
+
+def label_featuresets(featuresets, labels):
+    '''
+    Returns (feature dict, label) training pairs for a story's labeled paragraphs.
+    labels has one label per paragraph, or None for unlabeled ones, which give no
+    pair. A paragraph that follows an unlabeled one gets no previous_quote.
+    '''
+    pairs = []
+    for i, (featureset, label) in enumerate(zip(featuresets, labels)):
+        if label is None:
+            continue
+        previous = i == 0 and START or labels[i - 1]
+        if previous is not None:
+            featureset = add_previous(featureset, previous)
+        pairs.append((featureset, label))
+    return pairs
+
+########## DECODING ##########
+
+class SequenceDecoder(object):
+    '''
+    Labels whole stories with a context model's BatchScorer.
+    '''
+    def __init__(self, scorer):
+        self.scorer = scorer
+        self.labels = scorer.labels
+        self.quote_index = self.labels.index(True) if True in self.labels else None
+
+    def decode(self, stories):
+        '''
+        Takes a list of stories, each a list of feature dicts from story_features,
+        and returns a list of (guess, certainty, quote probability) triples for
+        each story. guess is the paragraph's label in the most probable sequence,
+        certainty its probability given the previous label in that sequence and
+        quote probability the probability of a quote given the same. Every
+        paragraph of every story is scored in one matrix product.
+        '''
+        candidates = []
+        for featuresets in stories:
+            for i, featureset in enumerate(featuresets):
+                for previous in (i == 0 and [START] or self.labels):
+                    candidates.append(add_previous(featureset, previous))
+        if not candidates:
+            return [[] for featuresets in stories]
+        probs = self.scorer.prob_matrix(candidates)
+
+        results, row = [], 0
+        for featuresets in stories:
+            # Conditional probabilities of each label, one row per previous label
+            steps = []
+            for i in range(len(featuresets)):
+                size = i == 0 and 1 or len(self.labels)
+                steps.append(probs[row:row + size])
+                row += size
+            results.append(self._viterbi(steps))
+        return results
+
+    def _viterbi(self, steps):
+        if not steps:
+            return []
+        logs = [numpy.log(numpy.maximum(step, MIN_PROBABILITY)) for step in steps]
+        best, pointers = logs[0][0], []
+        for log in logs[1:]:
+            paths = best[:, numpy.newaxis] + log
+            pointers.append(paths.argmax(axis=0))
+            best = paths.max(axis=0)
+
+        path = [int(best.argmax())]
+        for pointer in reversed(pointers):
+            path.append(int(pointer[path[-1]]))
+        path.reverse()
+
+        results = []
+        for i, label in enumerate(path):
+            step = steps[i][i and path[i - 1] or 0]
+            quote_prob = self.quote_index is not None and float(step[self.quote_index]) or 0.0
+            results.append((self.labels[label], float(step[label]), quote_prob))
+        return results
+
+########## EVALUATION ##########
+
+def score_stories(decoder, stories):
+    '''
+    Decodes a list of (feature dicts, labels) stories and returns parallel lists
+    of the true labels, guesses and quote probabilities of every labeled paragraph.
+    '''
+    truths, guesses, probs = [], [], []
+    decoded = decoder.decode([featuresets for featuresets, labels in stories])
+    for (featuresets, labels), results in zip(stories, decoded):
+        for label, (guess, certainty, quote_prob) in zip(labels, results):
+            if label is not None:
+                truths.append(label)
+                guesses.append(guess)
+                probs.append(quote_prob)
+    return truths, guesses, probs
+
+def _run_story_fold(args):
+    '''
+    Trains on one fold's training stories and decodes its test stories. Runs in
+    a worker process, so it only gets plain data.
+    '''
+    train_stories, test_stories, options = args
+    train_set = []
+    for featuresets, labels in train_stories:
+        train_set.extend(label_featuresets(featuresets, labels))
+    classifier, history = train_classifier(train_set, **options)
+    return score_stories(SequenceDecoder(BatchScorer(classifier)), test_stories)
+
+def cross_validate_stories(stories, k=5, jobs=1, seed=0, bins=CALIBRATION_BINS, **options):
+    '''
+    k-fold cross-validation over a list of (feature dicts, labels) stories, like
+    classify.evaluation.cross_validate. Whole stories are dealt out to the folds,
+    so no story is split between training and testing.
+    '''
+    order = range(len(stories))
+    random.Random(seed).shuffle(order)
+    folds = [[stories[i] for i in order[fold::k]] for fold in range(k)]
+    tasks = []
+    for fold in range(k):
+        train_stories = [story for n, stories_in in enumerate(folds) if n != fold for story in stories_in]
+        tasks.append((train_stories, folds[fold], options))
+    return run_folds(_run_story_fold, tasks, jobs, bins)
@@ -0,0 +1,116 @@
+'''
+corpus.py
+
+Streaming access to Paragraph querysets. Rows are fetched a chunk at a time in
+primary key order, so memory stays flat however large the corpus is.
+'''
+from collections import namedtuple
+from itertools import groupby
+from django.db import reset_queries
+from classify.instrument import metrics
+
+# Number of rows fetched per query
+CHUNK_SIZE = 1000
+
+# SQLite refuses statements with more than this many query parameters
+MAX_QUERY_PARAMS = 999
+
+# Ids per IN clause, leaving room under MAX_QUERY_PARAMS for the rest of the query
+ID_BATCH_SIZE = 900
+
+# Number of stories fetched per chunk by iter_stories. Keeps story id lists
+# under MAX_QUERY_PARAMS.
+STORY_CHUNK_SIZE = 100
+
+# Lightweight stand-in for a Paragraph. Has the pk, text and quote attributes
+# MaxentWrapper uses, so it can be passed anywhere Paragraphs are accepted.
+ParagraphRow = namedtuple('ParagraphRow', ['pk', 'text', 'quote'])
+
+# A story's paragraphs in order, as ParagraphRows, and the set of pks of those
+# selected for training, evaluation or classification. The rest are context.
+StoryRows = namedtuple('StoryRows', ['story', 'rows', 'selected'])
+
+########## QUERYSETS ##########
+
+def stale_paragraphs(queryset, model_version):
+    '''
+    Filters a queryset down to the paragraphs an incremental classification run
+    with the given model has to score: those never classified, those classified
+    by another model version and those whose text was edited after they were
+    classified (Paragraph.save clears their model version). Training paragraphs
+    are left out so their manual labels are never overwritten.
+    '''
+    return queryset.filter(for_training=False).exclude(model_version=model_version)
+
+########## STREAMING ##########
+
+def iter_keyset(queryset, key='pk', chunk_size=CHUNK_SIZE):
+    '''
+    Yields the rows of a values() or values_list() queryset in lists of up to
+    chunk_size, in key order. Each list is fetched with keyset pagination: a
+    filter for keys greater than the last one seen. Rows from values_list must
+    have the key first.
+
+    The queryset can be filtered but not sliced, since each chunk is fetched
+    by adding a filter to it. To split a set of rows, filter on key ranges instead.
+    '''
+    queryset = queryset.order_by(key)
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(**{key + '__gt': last})
+        with metrics.timer('query'):
+            rows = list(chunk[:chunk_size])
+        # With DEBUG on, Django keeps a log of every query. Clear it so long
+        # runs don't grow it without bound.
+        reset_queries()
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1]
+        if isinstance(last, dict):
+            last = last[key]
+        elif isinstance(last, tuple):
+            last = last[0]
+
+def iter_paragraphs(queryset, chunk_size=CHUNK_SIZE):
+    '''
+    Yields a ParagraphRow for every paragraph in a queryset, in pk order,
+    fetching chunk_size at a time with iter_keyset.
+    '''
+    for rows in iter_keyset(queryset.values_list('pk', 'text', 'quote'), chunk_size=chunk_size):
+        for row in rows:
+            yield ParagraphRow(*row)
+
+def iter_pks(queryset, chunk_size=CHUNK_SIZE):
+    '''
+    Yields the pk of every paragraph in a queryset, in pk order. Same rules
+    as iter_paragraphs.
+    '''
+    for pks in iter_keyset(queryset.values_list('pk', flat=True), chunk_size=chunk_size):
+        for pk in pks:
+            yield pk
+
+def iter_stories(queryset, context=None, chunk_size=STORY_CHUNK_SIZE):
+    '''
+    Yields a StoryRows for every story with paragraphs in a queryset, in story
+    id order. Its rows are every paragraph of the story in context, another
+    Paragraph queryset that defaults to the queryset itself, in story order.
+    Its selected pks are those of the paragraphs in the queryset.
+
+    So iter_stories(Paragraph.unclassified.all(), Paragraph.objects.all())
+    selects the unclassified paragraphs but gives each of them its whole story.
+    '''
+    story_ids = queryset.values_list('story', flat=True).distinct()
+    for ids in iter_keyset(story_ids, key='story', chunk_size=chunk_size):
+        with metrics.timer('query'):
+            rows = list((context if context is not None else queryset).filter(story__in=ids)
+                .order_by('story', 'order', 'pk').values_list('story', 'pk', 'text', 'quote'))
+            if context is not None:
+                selected = set(queryset.filter(story__in=ids).values_list('pk', flat=True))
+            else:
+                selected = set(row[1] for row in rows)
+        reset_queries()
+        for story, story_rows in groupby(rows, lambda row: row[0]):
+            story_rows = [ParagraphRow(*row[1:]) for row in story_rows]
+            yield StoryRows(story, story_rows, set(row.pk for row in story_rows if row.pk in selected))
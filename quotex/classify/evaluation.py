@@ -0,0 +1,160 @@
+'''
+evaluation.py
+
+Metrics and k-fold cross-validation for the quote classifier.
+
+A single train/test split of a few hundred labeled paragraphs gives noisy
+numbers. cross_validate splits the labeled set into k folds, keeping the share
+of quotes about the same in each fold, and trains and scores every fold. Folds
+run in parallel worker processes. Features are extracted once, before any fold
+is trained, and shared by all of them. Results come back as dicts of counts,
+precision, recall, F1 and calibration data, so they can be compared or logged
+instead of read off the screen.
+'''
+import random
+from multiprocessing import Pool
+from classify.scoring import BatchScorer
+from classify.train import train_classifier
+
+# Number of equal-width probability bins used for calibration data
+CALIBRATION_BINS = 10
+
+########## METRICS ##########
+
+def get_metrics(truths, guesses, probs, bins=CALIBRATION_BINS):
+    '''
+    Computes classification metrics from parallel lists of true labels, guessed
+    labels and the predicted probability that each paragraph is a quote.
+
+    Calibration data has one entry per probability bin: how many paragraphs were
+    predicted in that range, their mean predicted probability and the fraction
+    of them that really are quotes. For a well calibrated model the last two
+    are close.
+    '''
+    pairs = zip(truths, guesses)
+    true_pos = sum(1 for truth, guess in pairs if truth and guess)
+    false_pos = sum(1 for truth, guess in pairs if not truth and guess)
+    true_neg = sum(1 for truth, guess in pairs if not truth and not guess)
+    false_neg = sum(1 for truth, guess in pairs if truth and not guess)
+
+    precision = true_pos and float(true_pos) / (true_pos + false_pos) or 0.0
+    recall = true_pos and float(true_pos) / (true_pos + false_neg) or 0.0
+    f1 = precision + recall and 2 * precision * recall / (precision + recall) or 0.0
+
+    calibration = []
+    for b in range(bins):
+        lower, upper = float(b) / bins, float(b + 1) / bins
+        members = [(truth, prob) for truth, prob in zip(truths, probs)
+            if lower <= prob < upper or (b == bins - 1 and prob == 1.0)]
+        calibration.append({
+            'lower': lower,
+            'upper': upper,
+            'count': len(members),
+            'mean_probability': members and sum(p for t, p in members) / len(members) or 0.0,
+            'observed_rate': members and float(sum(1 for t, p in members if t)) / len(members) or 0.0,
+        })
+
+    return {
+        'count': len(truths),
+        'true_pos': true_pos,
+        'false_pos': false_pos,
+        'true_neg': true_neg,
+        'false_neg': false_neg,
+        'accuracy': truths and float(true_pos + true_neg) / len(truths) or 0.0,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'brier': truths and sum((p - (t and 1.0 or 0.0)) ** 2 for t, p in zip(truths, probs)) / len(truths) or 0.0,
+        'calibration': calibration,
+    }
+
+def score_featuresets(scorer, featuresets):
+    '''
+    Returns the guessed labels and probabilities of being a quote for a list of
+    feature dicts, using a BatchScorer.
+    '''
+    if not featuresets:
+        return [], []
+    probs = scorer.prob_matrix(featuresets)
+    guesses = [scorer.labels[j] for j in probs.argmax(axis=1)]
+    if True in scorer.labels:
+        quote_probs = [float(p) for p in probs[:, scorer.labels.index(True)]]
+    else:
+        quote_probs = [0.0] * len(featuresets)
+    return guesses, quote_probs
+
+########## CROSS-VALIDATION ##########
+
+def assign_folds(labels, k, seed=0):
+    '''
+    Returns a fold number between 0 and k-1 for each label. Items are shuffled
+    within each label and dealt out to the folds in turn, so every fold gets
+    about the same share of each label.
+    '''
+    rng = random.Random(seed)
+    folds = [None] * len(labels)
+    position = 0
+    for label in sorted(set(labels)):
+        indices = [i for i, l in enumerate(labels) if l == label]
+        rng.shuffle(indices)
+        for i in indices:
+            folds[i] = position % k
+            position += 1
+    return folds
+
+def _run_fold(args):
+    '''
+    Trains on one fold's training set and scores its test set. Runs in a worker
+    process, so it only gets plain data.
+    '''
+    train_set, test_featuresets, test_labels, options = args
+    classifier, history = train_classifier(train_set, **options)
+    guesses, probs = score_featuresets(BatchScorer(classifier), test_featuresets)
+    return test_labels, guesses, probs
+
+def cross_validate(featuresets, labels, k=5, jobs=1, seed=0, bins=CALIBRATION_BINS, **options):
+    '''
+    k-fold cross-validation over precomputed feature dicts and their labels. Other
+    keyword arguments are training options for classify.train.train_classifier.
+    With jobs > 1, folds are trained and scored in that many worker processes.
+
+    Returns a dict with the metrics of each fold under 'folds' and the metrics of
+    all folds' predictions pooled together under 'overall'.
+    '''
+    folds = assign_folds(labels, k, seed)
+    tasks = []
+    for fold in range(k):
+        train_set = [(f, l) for f, l, n in zip(featuresets, labels, folds) if n != fold]
+        test = [(f, l) for f, l, n in zip(featuresets, labels, folds) if n == fold]
+        tasks.append((train_set, [f for f, l in test], [l for f, l in test], options))
+    return run_folds(_run_fold, tasks, jobs, bins)
+
+def run_folds(run_fold, tasks, jobs=1, bins=CALIBRATION_BINS):
+    '''
+    Calls run_fold on each fold's task, in up to jobs worker processes, and
+    returns the cross-validation results described in cross_validate. run_fold
+    has to be a module-level function, so it can be sent to a worker, and return
+    the fold's true labels, guesses and quote probabilities.
+    '''
+    if jobs > 1:
+        pool = Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(run_fold, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(run_fold, tasks)
+
+    all_truths, all_guesses, all_probs = [], [], []
+    fold_metrics = []
+    for truths, guesses, probs in results:
+        fold_metrics.append(get_metrics(truths, guesses, probs, bins))
+        all_truths.extend(truths)
+        all_guesses.extend(guesses)
+        all_probs.extend(probs)
+    return {
+        'k': len(tasks),
+        'folds': fold_metrics,
+        'overall': get_metrics(all_truths, all_guesses, all_probs, bins),
+    }
@@ -9,47 +9,125 @@ under the inactive features heading purely for instructional purposes.
 '''
 import re
 import nltk
-from classify.constants import ATTRIBUTION_WORDS_STEMMED, PRONOUNS, PUNCTUATION_TO_REMOVE
+from collections import namedtuple
+from classify.constants import ATTRIBUTION_WORDS_STEMMED, PRONOUNS, PUNCTUATION_TO_REMOVE, \
+    QUOTE_SCAN_CACHE_SIZE, STEM_CACHE_SIZE
+from classify.instrument import metrics
+from classify.lru import LRUCache
 from nltk.stem.porter import PorterStemmer
 
+# Precompiled patterns shared by the features below and the FeatureExtractor
+PUNCTUATION_RE = re.compile('[%s]' % re.escape(''.join(PUNCTUATION_TO_REMOVE)))
+QUOTE_RE = re.compile('"')
+SAID_AFTER_SOURCE_RE = re.compile(r'\b(he|she|[A-Z][a-z]+)\W+(?:\w+\W+){0,5}(said|added|says)\b')
+SAID_BEFORE_SOURCE_RE = re.compile(r'\b(said|added|says){0,5}(he|she|[A-Z][a-z]+)\W+(?:\w+\W+)\b')
+
+# Result of scan_quotes. marks are the offsets of every quote mark, spans the
+# (start, end) offsets of the text between each opening mark and its closing
+# mark (or the end of the text, if it has none) and num_words the total number
+# of words in those spans.
+QuoteScan = namedtuple('QuoteScan', ['marks', 'spans', 'num_words'])
+
+_stopwords = None
+_quote_scans = LRUCache(QUOTE_SCAN_CACHE_SIZE)
+
+########## STEM CACHE ##########
+
+class StemCache(LRUCache):
+    '''
+    Memoizes Porter stems with least-recently-used eviction.
+
+    News vocabulary is heavily skewed toward a small set of common words, so
+    most stemming calls can be answered from the cache. The size bound keeps
+    memory flat in long-running classification workers: once maxsize words
+    are cached, the least recently used one is dropped for each new word.
+    '''
+    def __init__(self, maxsize=STEM_CACHE_SIZE, stemmer=None):
+        super(StemCache, self).__init__(maxsize)
+        self.stemmer = stemmer or PorterStemmer()
+
+    def stem(self, word):
+        '''
+        Returns the stem of a word, computing it only on a cache miss.
+        '''
+        stem = self.get(word)
+        if stem is None:
+            stem = self.stemmer.stem_word(word)
+            self.set(word, stem)
+        return stem
+
+# Shared by clean_text, the FeatureExtractor and every feature built on them
+stem_cache = StemCache()
+
 ########## HELPER FUNCTIONS ##########
 
+def get_stopwords():
+    """
+    Returns NLTK's English stopwords as a frozenset. The corpus is only read
+    from disk the first time this is called.
+    """
+    global _stopwords
+    if _stopwords is None:
+        _stopwords = frozenset(nltk.corpus.stopwords.words('english'))
+    return _stopwords
+
 def bracketed_find(s, start, end, startat=0):
     """
     Function to find content in between two words or characters without regex.
     From http://stackoverflow.com/questions/1116172/finding-content-between-two-words-withou-regex-beautifulsoup-lxml-etc
+    but iterative, so paragraphs with lots of quote marks can't hit the recursion limit.
     """
-    startloc=s.find(start, startat)
-    if startloc==-1:
-        return []
-    endloc=s.find(end, startloc+len(start))
-    if endloc == -1:
-        return [s[startloc+len(start):]]
-    return [s[startloc+len(start):endloc]] + bracketed_find(s, start, end, endloc+len(end))
+    found = []
+    startloc = s.find(start, startat)
+    while startloc != -1:
+        endloc = s.find(end, startloc+len(start))
+        if endloc == -1:
+            found.append(s[startloc+len(start):])
+            break
+        found.append(s[startloc+len(start):endloc])
+        startloc = s.find(start, endloc+len(end))
+    return found
+
+def scan_quotes(words):
+    """
+    Finds every quote mark in the input text and the spans of text between
+    them in one pass, pairing marks up the same way as bracketed_find(words,
+    '"', '"'). Returns a QuoteScan.
+
+    The quote features below and Paragraph.num_words all work from this scan.
+    The most recent scans are cached by text, so building a feature dict scans
+    each paragraph once no matter how many features look at its quotes.
+    """
+    scan = _quote_scans.get(words)
+    if scan is None:
+        marks = tuple(m.start() for m in QUOTE_RE.finditer(words))
+        spans, num_words = [], 0
+        for i in range(0, len(marks), 2):
+            span = (marks[i] + 1, marks[i+1] if i + 1 < len(marks) else len(words))
+            spans.append(span)
+            num_words += len(words[span[0]:span[1]].split())
+        scan = QuoteScan(marks, tuple(spans), num_words)
+        _quote_scans.set(words, scan)
+    return scan
 
 def get_words_outside_quotes(words, n=5):
     """
     Function to get words within n characters of quote marks.
     """
-    quote_indices = [m.start() for m in re.finditer('"', words)]
-    for i in range(len(quote_indices)):
-        if i % 2 != 0:
-            index = quote_indices[i] + 1
-            try:
-                next = quote_indices[i+1]
-            except IndexError:
-                next = len(words)
-            return words[index:next].strip().split()[:5]
+    quote_indices = scan_quotes(words).marks
+    if len(quote_indices) > 1:
+        index = quote_indices[1] + 1
+        next = quote_indices[2] if len(quote_indices) > 2 else len(words)
+        return words[index:next].strip().split()[:5]
 
 def clean_text(words):
     """
     Function to clean input text by removing select punctuation and stopwords
     and stemming with a Porter stemmer.
     """
-    for p in PUNCTUATION_TO_REMOVE:
-        words = words.replace(p, '')
-    stopwords = nltk.corpus.stopwords.words('english')
-    return ' '.join([PorterStemmer().stem_word(w) for w in words.split() if w not in stopwords])
+    words = PUNCTUATION_RE.sub('', words)
+    stopwords, stem = get_stopwords(), stem_cache.stem
+    return ' '.join([stem(w) for w in words.split() if w not in stopwords])
 
 ########## ACTIVE FEATURES ##########
 
@@ -60,10 +138,7 @@ def contains_quotes(words):
     this won't catch them. Same goes for any other feature that looks for
     quotes.
     """
-    contains_quotes = False
-    if words.find('"') > -1:
-        contains_quotes = True
-    return contains_quotes
+    return bool(scan_quotes(words).marks)
 
 def first_quote_index(words):
     """
@@ -75,7 +150,8 @@ def first_quote_index(words):
     with continuous variables. Grouping them as every 10th position effectively
     makes the data categorical (the 10s, 20s, 30s, etc.)
     """
-    return round(words.find('"'), -1)
+    marks = scan_quotes(words).marks
+    return round(marks[0] if marks else -1, -1)
 
 def last_word(words):
     '''
@@ -95,8 +171,7 @@ def said_near_source(words):
     '''
     words = clean_text(words)
     said_near_source = False
-    if len(re.findall(r'\b(he|she|[A-Z][a-z]+)\W+(?:\w+\W+){0,5}(said|added|says)\b', words)) > 0 \
-        or len(re.findall(r'\b(said|added|says){0,5}(he|she|[A-Z][a-z]+)\W+(?:\w+\W+)\b', words)) > 0:
+    if SAID_AFTER_SOURCE_RE.search(words) or SAID_BEFORE_SOURCE_RE.search(words):
         said_near_source = True
     return said_near_source
 
@@ -106,11 +181,7 @@ def num_words_between_quotes(words):
     text that fall between quote marks. Returns that number rounded to the nearest
     5 words, again to make the continuous data more categorical.
     '''
-    num_words_between_quotes = 0
-    lots_of_words_between_quotes = False
-    for q in bracketed_find(words, '"', '"'):
-        num_words_between_quotes += len(q.split())
-    return round(num_words_between_quotes, -1) / 2
+    return round(scan_quotes(words).num_words, -1) / 2
 
 def words_near_quotes(words):
     '''
@@ -172,16 +243,85 @@ def pct_words_between_quotes(words):
     that to a percentage.
     '''
     total_words = len(words.split())
-    num_words_between_quotes = 0
-    lots_of_words_between_quotes = False
-    for q in bracketed_find(words, '"', '"'):
-        num_words_between_quotes += len(q.split())
-    return round(float(num_words_between_quotes)/float(total_words), 0)
+    return round(float(scan_quotes(words).num_words)/float(total_words), 0)
+
+########## FEATURE EXTRACTOR ##########
+
+class FeatureExtractor(object):
+    '''
+    Builds the active feature dict for a paragraph in a single pass.
+
+    The standalone feature functions above each call clean_text on their own,
+    so building one feature dict used to tokenize, filter and stem the same
+    paragraph five or more times. This class cleans the text once and derives
+    every feature from that one result. The output is identical to calling the
+    individual functions, so models trained on either are interchangeable.
+    '''
+    def __init__(self, stopwords=None, cache=None):
+        self.stopwords = stopwords if stopwords is not None else get_stopwords()
+        self.stem_cache = cache if cache is not None else stem_cache
+
+    def clean(self, words):
+        '''
+        Returns the cleaned tokens of the input text. Same output as
+        clean_text(words).split().
+        '''
+        stopwords, stem = self.stopwords, self.stem_cache.stem
+        return [stem(w) for w in PUNCTUATION_RE.sub('', words).split() if w not in stopwords]
+
+    def last_word(self, tokens):
+        '''
+        Equivalent of last_word(clean_text(words)), which cleans the text twice.
+        Cleaning is token by token, so only the last token that survives the
+        second stopword filter needs to be stemmed again.
+        '''
+        for token in reversed(tokens):
+            if token not in self.stopwords:
+                return self.stem_cache.stem(token)
+        return False
+
+    def extract(self, words):
+        '''
+        Returns a feature dict in the format expected by NLTK. With
+        instrumentation on, cleaning and each feature are timed separately.
+        '''
+        return self.analyze(words)[0]
+
+    def analyze(self, words):
+        '''
+        Returns the feature dict for a paragraph along with its cleaned tokens,
+        so classify.context can derive story features without cleaning it again.
+        '''
+        timer = metrics.timer
+        with timer('features.clean'):
+            tokens = self.clean(words)
+            cleaned = ' '.join(tokens)
+
+        features = {}
+        with timer('features.contains_quotes'):
+            features['contains_quotes'] = contains_quotes(words)
+        with timer('features.first_quote_index'):
+            features['first_quote_index'] = first_quote_index(words)
+        with timer('features.last_word'):
+            features['last_word_%s' % self.last_word(tokens)] = True
+        with timer('features.said_near_source'):
+            features['said_near_source'] = bool(SAID_AFTER_SOURCE_RE.search(cleaned)
+                or SAID_BEFORE_SOURCE_RE.search(cleaned))
+        with timer('features.num_words_between_quotes'):
+            features['num_words_between_quotes'] = num_words_between_quotes(words)
+        with timer('features.words_near_quotes'):
+            for word in get_words_outside_quotes(cleaned) or []:
+                features['%s_near_quote' % word] = True
+        metrics.count('paragraphs_extracted')
+        return features, tokens
+
+_extractor = None
 
-def preceded_by_quote(story, graf_order):
+def get_extractor():
     '''
-    Returns true if the previous paragraph is also a quote.
+    Returns a shared FeatureExtractor, created the first time it's needed.
     '''
-    if Paragraph.objects.get(story=story, order=graf_order-1).quote == True:
-        return True
-    return False
\ No newline at end of file
+    global _extractor
+    if _extractor is None:
+        _extractor = FeatureExtractor()
+    return _extractor
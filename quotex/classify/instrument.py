@@ -0,0 +1,213 @@
+'''
+instrument.py
+
+Optional timing instrumentation and sampling profiler.
+
+The classification pipeline is wrapped in named stages, such as querying,
+cleaning text, each feature, scoring and writing results. When instrumentation
+is on, each stage records how many times it ran and how long it took, and
+counters record things like paragraphs processed and cache hits. snapshot()
+returns everything as a dict. to_json() and to_prometheus() format it for
+logging or for a Prometheus textfile collector.
+
+Instrumentation is off by default, and a stage then costs one attribute check.
+Turn it on with metrics.enable() or by setting QUOTEX_METRICS=1 in the
+environment. Each process keeps its own metrics, so classify_parallel workers
+aren't included in the parent's totals.
+
+SamplingProfiler is a separate, heavier tool. It interrupts the process every
+few milliseconds with SIGPROF and counts the stacks it finds, so hot functions
+show up in proportion to the CPU time spent in them. write_collapsed() saves
+the counts in the collapsed-stack format read by flamegraph.pl and speedscope.
+'''
+import json
+import os
+import signal
+import time
+from collections import defaultdict
+
+# Seconds of CPU time between profiler samples
+PROFILE_INTERVAL = 0.005
+
+# Prefix of every metric name in the Prometheus output
+PROMETHEUS_PREFIX = 'quotex'
+
+########## METRICS ##########
+
+class _NullTimer(object):
+    '''
+    Does nothing, for stages timed while instrumentation is off.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_timer = _NullTimer()
+
+class _Timer(object):
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.stage, time.time() - self.start)
+        return False
+
+class Metrics(object):
+    '''
+    Per-stage timings and counters for one process.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        '''
+        Forgets everything recorded so far.
+        '''
+        self.stages = {}
+        self.counters = defaultdict(int)
+        self.started = time.time()
+
+    def timer(self, stage):
+        '''
+        Returns a context manager that times the code it wraps as one run of stage.
+        '''
+        if not self.enabled:
+            return _null_timer
+        return _Timer(self, stage)
+
+    def record(self, stage, seconds, calls=1):
+        '''
+        Records calls runs of stage that took seconds in total.
+        '''
+        if not self.enabled:
+            return
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+        stats['calls'] += calls
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds / calls if calls else 0.0)
+
+    def count(self, name, n=1):
+        '''
+        Adds n to the named counter.
+        '''
+        if self.enabled:
+            self.counters[name] += n
+
+    def snapshot(self):
+        '''
+        Returns everything recorded so far as a dict, including the mean seconds
+        per call of each stage.
+        '''
+        stages = {}
+        for stage, stats in self.stages.items():
+            stages[stage] = dict(stats, mean_seconds=stats['seconds'] / stats['calls'] if stats['calls'] else 0.0)
+        return {
+            'pid': os.getpid(),
+            'elapsed_seconds': time.time() - self.started,
+            'stages': stages,
+            'counters': dict(self.counters),
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        '''
+        Returns the snapshot in the Prometheus text exposition format.
+        '''
+        snapshot = self.snapshot()
+        lines = []
+        for name, kind, key in (('stage_calls_total', 'counter', 'calls'),
+                ('stage_seconds_total', 'counter', 'seconds'),
+                ('stage_max_seconds', 'gauge', 'max_seconds')):
+            lines.append('# TYPE %s_%s %s' % (PROMETHEUS_PREFIX, name, kind))
+            for stage, stats in sorted(snapshot['stages'].items()):
+                lines.append('%s_%s{stage="%s"} %r' % (PROMETHEUS_PREFIX, name, stage, stats[key]))
+        lines.append('# TYPE %s_events_total counter' % PROMETHEUS_PREFIX)
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('%s_events_total{name="%s"} %s' % (PROMETHEUS_PREFIX, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''
+        Saves a snapshot to path, in Prometheus format if it ends in .prom and
+        as JSON otherwise.
+        '''
+        with open(path, 'w') as f:
+            f.write(path.endswith('.prom') and self.to_prometheus() or self.to_json())
+
+# Shared by every instrumented module
+metrics = Metrics(enabled=bool(os.environ.get('QUOTEX_METRICS')))
+
+########## SAMPLING PROFILER ##########
+
+class SamplingProfiler(object):
+    '''
+    Statistical profiler driven by SIGPROF. Only works on Unix, and only
+    samples the main thread. Use start() and stop(), or use it as a context
+    manager.
+    '''
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self.total = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+        self.total += 1
+
+    def top(self, n=20):
+        '''
+        Returns the n functions seen most often at the top of the stack, as
+        (function, share of samples) pairs.
+        '''
+        own = defaultdict(int)
+        for stack, count in self.samples.items():
+            own[stack.rsplit(';', 1)[-1]] += count
+        return [(function, float(count) / self.total)
+            for function, count in sorted(own.items(), key=lambda item: -item[1])[:n]]
+
+    def write_collapsed(self, path):
+        '''
+        Saves the samples as collapsed stacks, one "frame;frame;frame count" per line.
+        '''
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write('%s %s\n' % (stack, count))
@@ -0,0 +1,85 @@
+'''
+lru.py
+
+A bounded cache with least-recently-used eviction, for the in-process caches
+of stems, quote scans, sampled quote ids and search results.
+'''
+import threading
+from collections import OrderedDict
+
+########## LRU CACHE ##########
+
+class LRUCache(object):
+    '''
+    Maps keys to values, keeping at most maxsize of them. Once it's full, the
+    least recently used entry is dropped for each new one. Every change is made
+    under a lock, so the web process can share a cache between threads.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        '''
+        Returns the value for key, or default if it isn't cached.
+        '''
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.data[key] = value # (Re)inserting marks the key as most recently used
+            return value
+
+    def set(self, key, value):
+        '''
+        Caches a value, evicting the least recently used entry if the cache is full.
+        '''
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            self._evict(len(self.data) - self.maxsize)
+
+    def resize(self, maxsize):
+        '''
+        Changes the size bound, evicting old entries if the cache is now too big.
+        '''
+        with self.lock:
+            self.maxsize = maxsize
+            self._evict(len(self.data) - maxsize)
+
+    def clear(self):
+        '''
+        Empties the cache and resets the counters.
+        '''
+        with self.lock:
+            self.data.clear()
+            self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def stats(self):
+        '''
+        Returns a dict of cache counters, for logging and tuning maxsize.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+    def _evict(self, n):
+        for i in range(n):
+            self.data.popitem(last=False)
+        self.evictions += max(n, 0)
@@ -13,10 +13,25 @@ http://www.cs.cmu.edu/afs/cs/user/aberger/www/html/tutorial/tutorial.html
 And here's some reference info for maxent in NLTK:
 http://nltk.googlecode.com/svn/trunk/doc/book/ch06.html
 '''
+import hashlib
+import json
+import time
+import numpy
 import nltk
-from nltk.classify import MaxentClassifier
-from quotex.apps.content.models import Paragraph
+from quotex.apps.content.models import Paragraph, hash_text
+from classify.constants import CONTEXT_VERSION, FEATURE_VERSION
+from classify.context import SequenceDecoder, cross_validate_stories, label_featuresets, story_features
+from classify.corpus import iter_paragraphs
 from classify.features import *
+from classify.scoring import BATCH_SIZE, BatchScorer, iter_batches
+from classify.evaluation import CALIBRATION_BINS, cross_validate, get_metrics, score_featuresets
+from classify.instrument import metrics
+from classify.model import MODEL_FORMAT_VERSION, MODEL_PATH, dump_model, load_model
+from classify.train import get_max_iter, train_classifier
+from classify.writer import ResultWriter
+
+# Number of stories decoded per batch by ContextMaxentWrapper
+STORY_BATCH_SIZE = 25
 
 ########## FEATURE AGGREGATOR ##########
 
@@ -25,18 +40,20 @@ def get_features(words):
     Function that aggregates active features for the maxent classifier and returns
     a feature dict in the format expected by NLTK.
     '''
-    features = {} # Start with empty feature dict
-
-    # Put features here (found in classify.features)
-    features['contains_quotes'] = contains_quotes(words)
-    features['first_quote_index'] = first_quote_index(words)
-    features['last_word_%s' % last_word(clean_text(words))] = True
-    features['said_near_source'] = said_near_source(words)
-    features['num_words_between_quotes'] = num_words_between_quotes(words)
-    for word in words_near_quotes(words):
-        features['%s_near_quote' % word] = True
+    # The active features live in classify.features. FeatureExtractor computes
+    # all of them from a single cleaning pass over the text.
+    return get_extractor().extract(words)
 
-    return features
+def hash_training_set(data):
+    '''
+    Returns a SHA-1 hex digest of a list of (text, label) training pairs. Saved
+    models carry this hash so you can tell which training set produced them.
+    '''
+    sha = hashlib.sha1()
+    for text, label in data:
+        sha.update(text.encode('utf-8'))
+        sha.update('\0%s\n' % label)
+    return sha.hexdigest()
 
 ########## MAXENT WRAPPER CLASS ##########
 
@@ -44,99 +61,345 @@ class MaxentWrapper(object):
     '''
     Simple wrapper around NLTK's maxent classifier to facilitate training
     and evaluation.
+
+    Call fit() to train on the training data, or load() a model that was
+    trained and saved earlier. Either way, evaluate() and classify() reuse
+    the same trained classifier instead of retraining on every call.
+
+    Training, test and unlabeled data can be lists or querysets of Paragraphs,
+    or the streaming iterators returned by classify.corpus.iter_paragraphs.
+    The training data is read into a list up front, so fit() and
+    cross_validate() can use it more than once, even from an iterator.
+
+    Pass store=classify.store.FeatureStore() to reuse features saved by earlier
+    runs instead of extracting them from the text every time.
     '''
-    def __init__(self, train):
-        self.train = train # Init requires training data
+    # Version of the story context features the model uses, if any
+    context_version = None
+
+    def __init__(self, train=None, store=None):
+        # Training data. Not needed for models from load()
+        self.train = list(train) if train is not None else None
+        self.store = store
+        self.classifier = None
+        self.scorer = None
+        self.train_hash = None
+        self.version = None
+        self.algorithm = None
+        self.max_iter = None
+        self.history = None
+
+    def _train(self, algo='iis', trace=0, max_iter=None, warm_start=None, **options):
+        '''
+        Internal method to train and return a NLTK maxent classifier. Options are
+        described in train_classifier. A previously trained MaxentWrapper can be
+        passed as warm_start.
+        '''
+        self.algorithm, self.max_iter = algo, get_max_iter(algo, max_iter)
+        train_set = self._get_training_set()
+        if warm_start is not None:
+            warm_start = warm_start.get_classifier()
+        with metrics.timer('train'):
+            classifier, self.history = train_classifier(train_set, algo=algo, trace=trace,
+                max_iter=self.max_iter, warm_start=warm_start, **options)
+        return classifier
+
+    def _get_training_set(self):
+        '''
+        Returns the training data as (feature dict, label) pairs and sets train_hash.
+        '''
+        items = self.train
+        self.train_hash = hash_training_set([(p.text, p.quote) for p in items])
+        return zip(self.get_featuresets(items), [p.quote for p in items])
+
+    def get_featuresets(self, items, save=True):
+        '''
+        Returns the feature dicts for a list of paragraphs, from the feature store
+        if there is one. Features the store didn't have are saved to it unless
+        save is False.
+        '''
+        with metrics.timer('featuresets'):
+            if self.store is not None:
+                return self.store.get_features(items, save=save)
+            return [get_features(item.text) for item in items]
 
-    def _train(self, algo='iis', trace=0, max_iter=10):
+    def fit(self, **kwargs):
         '''
-        Internal method to train and return a NLTK maxent classifier.
-        ''' 
-        data = [(p.text, p.quote) for p in train_query]
-        train_set = [(get_features(n), g) for (n, g) in data]
-        return MaxentClassifier.train(train_set, algorithm=algo, trace=trace, max_iter=max_iter)
+        Train the classifier on the training data. Keyword arguments are passed
+        through to _train. Returns self so calls can be chained.
+        '''
+        if self.train is None:
+            raise ValueError('MaxentWrapper needs training data to fit a classifier')
+        self.classifier = self._train(**kwargs)
+        self.scorer = None
+        self.version = None
+        return self
 
-    def evaluate(self, test):
+    def get_classifier(self):
+        '''
+        Returns the trained classifier, fitting it first if that hasn't happened yet.
+        '''
+        if self.classifier is None:
+            self.fit()
+        return self.classifier
+
+    def get_scorer(self):
+        '''
+        Returns a BatchScorer for the trained classifier, building it on first use.
+        '''
+        if self.scorer is None:
+            self.scorer = BatchScorer(self.get_classifier())
+        return self.scorer
+
+    def get_version(self):
+        '''
+        Returns an identifier for the trained model: a hash of the feature version,
+        the feature encoding and the weights. Classified paragraphs record the version
+        of the model that classified them.
+        '''
+        if self.version is None:
+            classifier = self.get_classifier()
+            mapping = sorted(classifier._encoding._mapping.items(), key=lambda item: item[1])
+            sha = hashlib.sha1(str(FEATURE_VERSION))
+            if self.context_version is not None:
+                sha.update('context:%s' % self.context_version)
+            sha.update(json.dumps([key for key, index in mapping]))
+            sha.update(numpy.asarray(classifier.weights(), dtype=float).tostring())
+            self.version = sha.hexdigest()
+        return self.version
+
+    def save(self, path=MODEL_PATH):
+        '''
+        Save the trained model to a gzipped JSON file. The file holds the feature
+        encoding and weights along with the model format version, the feature
+        version, the model version and a hash of the training set.
+        '''
+        classifier = self.get_classifier()
+        encoding = classifier._encoding
+        mapping = sorted(encoding._mapping.items(), key=lambda item: item[1])
+        model = {
+            'format_version': MODEL_FORMAT_VERSION,
+            'feature_version': FEATURE_VERSION,
+            'context_version': self.context_version,
+            'version': self.get_version(),
+            'train_hash': self.train_hash,
+            'algorithm': self.algorithm,
+            'max_iter': self.max_iter,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'labels': list(encoding.labels()),
+            'mapping': [list(key) for key, index in mapping],
+            'weights': [float(w) for w in classifier.weights()],
+        }
+        return dump_model(model, path)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH, store=None):
+        '''
+        Load a model saved with save(). The returned wrapper is ready to evaluate
+        and classify without any training data.
+        '''
+        classifier, model = load_model(path, context_version=cls.context_version)
+        wrapper = cls(store=store)
+        wrapper.classifier = classifier
+        wrapper.version = model.get('version')
+        wrapper.train_hash = model['train_hash']
+        wrapper.algorithm = model['algorithm']
+        wrapper.max_iter = model['max_iter']
+        return wrapper
+
+    def evaluate(self, test, bins=CALIBRATION_BINS):
         '''
         Evaluate the performance of a test set. The test set should contain labeled data,
         just like a training set. The purpose of this method is to see how well your trained
         classifier performs on quotes you have already vetted and classified. Takes a list or
         queryset of Paragraph objects as input.
+
+        Returns a dict of metrics (see classify.evaluation.get_metrics), plus the pks of the
+        false positives and false negatives so problems are easier to diagnose.
         '''
-        classifier = self._train() # Get the classifier
-
-        true_pos, false_pos, true_neg, false_neg = 0, 0, 0, 0
-        for item in test:
-            # Ground truth data. The quote status should already be flagged manually in the test
-            # set before you run this.
-            truth = item.quote
-
-            # Create a classifier with features extracted from the item text
-            features = get_features(item.text)
-            classify = classifier.prob_classify(features)
-            guess = classify.max() # Return guess with the highest probability.
-
-            # Add up true positives, false positives, true negatives and false negatives. Also
-            # print the text and feature sets for false positives and false negatives so problems
-            # are easier to diagnose.
-            if truth == True and guess == True:
-                true_pos += 1
-            elif truth == True and guess == False:
-                print item.text
-                print features
-                false_neg += 1
-            elif truth == False and guess == False:
-                true_neg += 1
-            elif truth == False and guess == True:
-                false_pos += 1
-                print item.text
-                print features
-
-        # Print stats
-        print 'True positives: %s' % true_pos
-        print 'False positives: %s' % false_pos
-        print 'True negatives: %s' % true_neg
-        print 'False negatives: %s' % false_neg
-
-        # Return the 10 most useful features learned by the classifier
-        print classifier.show_most_informative_features(10)
-        return
-
-    def classify(self, to_classify):
+        scorer = self.get_scorer()
+
+        truths, guesses, probs = [], [], []
+        false_positives, false_negatives = [], []
+        for batch in iter_batches(test):
+            batch_guesses, batch_probs = score_featuresets(scorer, self.get_featuresets(batch))
+
+            # Compare against the ground truth data. The quote status should already be flagged
+            # manually in the test set before you run this.
+            for item, guess in zip(batch, batch_guesses):
+                if item.quote and not guess:
+                    false_negatives.append(item.pk)
+                elif not item.quote and guess:
+                    false_positives.append(item.pk)
+            truths.extend(item.quote for item in batch)
+            guesses.extend(batch_guesses)
+            probs.extend(batch_probs)
+
+        results = get_metrics(truths, guesses, probs, bins)
+        results['false_positives'] = false_positives
+        results['false_negatives'] = false_negatives
+        return results
+
+    def cross_validate(self, k=5, jobs=1, seed=0, bins=CALIBRATION_BINS, **options):
+        '''
+        k-fold cross-validation on the training data, with folds trained and scored in
+        jobs worker processes. Features are extracted (or fetched from the feature store)
+        once and shared by every fold. Other keyword arguments are training options, as
+        for fit(). Returns per-fold and overall metrics; see classify.evaluation.
+        '''
+        items = self.train
+        return cross_validate(self.get_featuresets(items), [item.quote for item in items],
+            k=k, jobs=jobs, seed=seed, bins=bins, **options)
+
+    def classify(self, to_classify, batch_size=BATCH_SIZE, writer=None, dry_run=False):
         '''
         Classify a set of unlabeled data, given a training set. Takes a list or queryset of
-        Paragraph objects as input.
+        Paragraph objects as input. Paragraphs are scored in batches of batch_size.
+
+        Results are written back in bulk through a ResultWriter. Pass your own writer to
+        control the chunk size, or dry_run=True to print the results instead of saving them.
+        Dry runs don't save anything to the feature store either.
         '''
-        classifier = self._train() # Get the classifier
-        for item in to_classify:
+        scorer = self.get_scorer()
+        version = self.get_version()
+        writer = writer or ResultWriter(dry_run=dry_run)
+        for batch in iter_batches(to_classify, batch_size):
 
-            # Create a classifier with features extracted from item text
-            features = get_features(item.text)
-            classify = classifier.prob_classify(features)
-            guess = classify.max()
+            # Extract features for the whole batch and score it in one go. Because this is
+            # a probabilistic classifier, each guess comes with the probability of that
+            # guess, which can be seen as an indicator of certainty.
+            results = scorer.score(self.get_featuresets(batch, save=not writer.dry_run))
 
-            # Because this is a proabilistic classifier, we can get the probability
-            # score of a given guess, which can be seen as an indicator of certainty.
-            certainty = float(classify.prob(guess))
+            # Queue the results to be written to the database, along with what's needed
+            # to tell later whether they are out of date
+            for item, (guess, certainty) in zip(batch, results):
+                writer.add(item.pk, guess, certainty, hash_text(item.text), version)
+            metrics.count('paragraphs_classified', len(batch))
+        writer.close()
+        return writer.written
 
-            # Save the Paragraph object to the database
-            item.quote = guess
-            item.score = certainty
-            item.save()
-        return
+class ContextMaxentWrapper(MaxentWrapper):
+    '''
+    MaxentWrapper for models that also use story context (see classify.context).
+
+    Works a story at a time instead of a paragraph at a time. Training, test
+    and unlabeled data are iterables of StoryRows, as returned by
+    classify.corpus.iter_stories. Only the selected paragraphs of each story
+    are trained on, evaluated or classified. The rest of the story is there
+    for context. Paragraphs are classified by decoding the most probable
+    sequence of labels for the whole story.
+
+    Context features depend on a paragraph's neighbors, so they aren't kept in
+    the feature store.
+    '''
+    context_version = CONTEXT_VERSION
+
+    def _get_training_set(self):
+        train_set, labeled = [], []
+        for story in self.train:
+            labels = self.get_labels(story)
+            train_set.extend(label_featuresets(self.get_story_featuresets(story), labels))
+            labeled.extend((row.text, label) for row, label in zip(story.rows, labels) if label is not None)
+        self.train_hash = hash_training_set(labeled)
+        return train_set
+
+    def get_labels(self, story):
+        '''
+        Returns the label of each paragraph of a story, or None for those that
+        aren't selected.
+        '''
+        return [row.quote if row.pk in story.selected else None for row in story.rows]
+
+    def get_story_featuresets(self, story):
+        '''
+        Returns the feature dicts for every paragraph of a story, with context.
+        '''
+        with metrics.timer('featuresets'):
+            return story_features([row.text for row in story.rows])
+
+    def get_decoder(self):
+        return SequenceDecoder(self.get_scorer())
+
+    def evaluate(self, test, bins=CALIBRATION_BINS):
+        '''
+        Evaluate the decoded labels of the selected paragraphs of a labeled set
+        of stories. Returns the same metrics as MaxentWrapper.evaluate.
+        '''
+        decoder = self.get_decoder()
+        truths, guesses, probs = [], [], []
+        false_positives, false_negatives = [], []
+        for batch in iter_batches(test, STORY_BATCH_SIZE):
+            decoded = decoder.decode([self.get_story_featuresets(story) for story in batch])
+            for story, results in zip(batch, decoded):
+                for row, (guess, certainty, quote_prob) in zip(story.rows, results):
+                    if row.pk not in story.selected:
+                        continue
+                    if row.quote and not guess:
+                        false_negatives.append(row.pk)
+                    elif not row.quote and guess:
+                        false_positives.append(row.pk)
+                    truths.append(row.quote)
+                    guesses.append(guess)
+                    probs.append(quote_prob)
+
+        results = get_metrics(truths, guesses, probs, bins)
+        results['false_positives'] = false_positives
+        results['false_negatives'] = false_negatives
+        return results
+
+    def cross_validate(self, k=5, jobs=1, seed=0, bins=CALIBRATION_BINS, **options):
+        '''
+        k-fold cross-validation on the training stories, keeping each story in
+        one fold. See classify.context.cross_validate_stories.
+        '''
+        stories = [(self.get_story_featuresets(story), self.get_labels(story)) for story in self.train]
+        return cross_validate_stories(stories, k=k, jobs=jobs, seed=seed, bins=bins, **options)
+
+    def classify(self, to_classify, batch_size=STORY_BATCH_SIZE, writer=None, dry_run=False):
+        '''
+        Classify the selected paragraphs of an iterable of stories, decoding
+        batch_size stories at a time. Results are written as in
+        MaxentWrapper.classify.
+        '''
+        decoder = self.get_decoder()
+        version = self.get_version()
+        writer = writer or ResultWriter(dry_run=dry_run)
+        for batch in iter_batches(to_classify, batch_size):
+            decoded = decoder.decode([self.get_story_featuresets(story) for story in batch])
+            for story, results in zip(batch, decoded):
+                for row, (guess, certainty, quote_prob) in zip(story.rows, results):
+                    if row.pk in story.selected:
+                        writer.add(row.pk, guess, certainty, hash_text(row.text), version)
+                metrics.count('paragraphs_classified', len(story.selected))
+        writer.close()
+        return writer.written
 
 ########## MAIN ##########
 
 if __name__ == '__main__':
-    # Train and test querysets for evaluate method
+    # Train and test sets for evaluate method. The training set is split in half by pk
+    # so that neither half has to be loaded into memory to find the split.
     training_set = Paragraph.training.all()
-    train_query = training_set[:len(training_set)/2]
-    test_query = training_set[len(training_set)/2:]
+    split_pk = training_set.order_by('pk').values_list('pk', flat=True)[training_set.count()/2]
+    train_query = iter_paragraphs(training_set.filter(pk__lt=split_pk))
+    test_query = iter_paragraphs(training_set.filter(pk__gte=split_pk))
 
     # Unlabeled data for the classify method
-    unlabeled = Paragraph.unclassified.all()
+    unlabeled = iter_paragraphs(Paragraph.unclassified.all())
+
+    # Evaluate a classifier trained on the first half of the training set
+    me_classifier = MaxentWrapper(train_query).fit()
+    results = me_classifier.evaluate(test_query)
+    for stat in ('true_pos', 'false_pos', 'true_neg', 'false_neg', 'precision', 'recall', 'f1'):
+        print '%s: %s' % (stat, results[stat])
+
+    # Return the 10 most useful features learned by the classifier
+    me_classifier.get_classifier().show_most_informative_features(10)
+
+    # For a less noisy estimate, cross-validate on the whole training set instead
+    #print MaxentWrapper(iter_paragraphs(training_set)).cross_validate(k=5, jobs=4)['overall']
 
-    # Evaluate and classify
-    me_classifier = MaxentWrapper(train_query)
-    me_classifier.evaluate(test_query)
-    #me_classifier.classify(unlabeled)
+    # To classify, train on the whole training set and save the model once. After
+    # that, loading the saved model is enough and no retraining is needed.
+    #MaxentWrapper(iter_paragraphs(training_set)).fit().save(MODEL_PATH)
+    #MaxentWrapper.load(MODEL_PATH).classify(unlabeled)
@@ -0,0 +1,69 @@
+'''
+model.py
+
+Reading and writing saved maxent models.
+
+A model is saved as gzipped JSON holding the feature encoding and weights,
+along with the model format version, the feature version it was trained on,
+the model version and a hash of the training set. This module only needs NLTK
+and numpy, not Django, so saved models can be loaded by tools that have no
+database (see classify/stream.py). MaxentWrapper.save and MaxentWrapper.load
+are built on it.
+'''
+import gzip
+import json
+import os
+import numpy
+from nltk.classify import MaxentClassifier
+from nltk.classify.maxent import BinaryMaxentFeatureEncoding
+from classify.constants import FEATURE_VERSION
+
+# Version of the on-disk model format
+MODEL_FORMAT_VERSION = 1
+
+# Default location for the persisted model
+MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'data', 'maxent.json.gz')
+
+def dump_model(model, path):
+    '''
+    Saves a model dict to a gzipped JSON file.
+    '''
+    f = gzip.open(path, 'wb')
+    try:
+        json.dump(model, f, separators=(',', ':'))
+    finally:
+        f.close()
+    return path
+
+def load_model(path=MODEL_PATH, context_version=None):
+    '''
+    Reads a saved model and returns a (classifier, model) pair, where model is the
+    dict that was saved. Raises ValueError if the file was written in another
+    format version or trained on another version of the features. Models that use
+    story context features (see classify.context) are only loaded if their
+    version is given as context_version, and other models only if it's None.
+    '''
+    f = gzip.open(path, 'rb')
+    try:
+        model = json.load(f)
+    finally:
+        f.close()
+
+    if model.get('format_version') != MODEL_FORMAT_VERSION:
+        raise ValueError('%s has model format version %s, expected %s' % (
+            path, model.get('format_version'), MODEL_FORMAT_VERSION))
+    if model.get('feature_version') != FEATURE_VERSION:
+        raise ValueError('%s was trained on feature version %s, but the current '
+            'features are version %s. Retrain the model.' % (
+            path, model.get('feature_version'), FEATURE_VERSION))
+    if model.get('context_version') != context_version:
+        if context_version is None:
+            raise ValueError('%s uses story context features. Load it with '
+                'classify.maxent.ContextMaxentWrapper.' % path)
+        raise ValueError('%s has story context version %s, expected %s' % (
+            path, model.get('context_version'), context_version))
+
+    mapping = dict((tuple(key), index) for index, key in enumerate(model['mapping']))
+    encoding = BinaryMaxentFeatureEncoding(model['labels'], mapping)
+    return MaxentClassifier(encoding, numpy.array(model['weights'])), model
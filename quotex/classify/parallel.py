@@ -0,0 +1,106 @@
+'''
+parallel.py
+
+Multi-core classification.
+
+Feature extraction is pure Python and CPU-bound, so MaxentWrapper.classify only
+ever keeps one core busy. classify_parallel splits the paragraph ids into
+batches and hands them to a pool of worker processes. Each worker loads the
+saved model once, then fetches, extracts features for and scores one batch at a
+time. Results, and any features a worker added to the feature store, come
+back to the parent process, which is the only one that writes to the database.
+'''
+import os
+import time
+from array import array
+from multiprocessing import Pool, cpu_count
+from django.db import connections
+from quotex.apps.content.models import Paragraph, hash_text
+from classify.corpus import ID_BATCH_SIZE, ParagraphRow, iter_pks
+from classify.maxent import MODEL_PATH, MaxentWrapper
+from classify.scoring import BATCH_SIZE, iter_batches
+from classify.store import FeatureStore
+from classify.writer import ResultWriter
+
+# Model and feature store loaded by each worker process in _init_worker
+_wrapper = None
+_store = None
+
+########## WORKER FUNCTIONS ##########
+
+def _init_worker(model_path, use_store):
+    '''
+    Runs once in each worker process to load the saved model and, if asked for,
+    a feature store that the worker only reads from.
+    '''
+    global _wrapper, _store
+    _wrapper = MaxentWrapper.load(model_path)
+    _store = use_store and FeatureStore() or None
+
+def _classify_batch(pks):
+    '''
+    Fetches, extracts features for and scores one batch of paragraphs. Returns
+    the worker's pid, the time spent, a list of (pk, guess, certainty, text_hash)
+    and the FeatureSet entries for the parent process to save to the store.
+    '''
+    start = time.time()
+    pks, rows = list(pks), []
+    for i in range(0, len(pks), ID_BATCH_SIZE):
+        rows.extend(ParagraphRow(pk, text, None)
+            for pk, text in Paragraph.objects.filter(pk__in=pks[i:i + ID_BATCH_SIZE]).values_list('pk', 'text'))
+    if _store is not None:
+        featuresets, entries = _store.lookup(rows)
+    else:
+        featuresets, entries = _wrapper.get_featuresets(rows), []
+    results = _wrapper.get_scorer().score(featuresets)
+    scored = [(row.pk, guess, certainty, hash_text(row.text))
+        for row, (guess, certainty) in zip(rows, results)]
+    return os.getpid(), time.time() - start, scored, entries
+
+########## PUBLIC FUNCTIONS ##########
+
+def classify_parallel(queryset, workers=None, model_path=MODEL_PATH, batch_size=BATCH_SIZE,
+    writer=None, dry_run=False, use_store=False):
+    '''
+    Classify every paragraph in a queryset using a pool of worker processes.
+    The model must already be saved at model_path. Writing is done by this
+    process through a ResultWriter, as in MaxentWrapper.classify. With
+    use_store=True, workers get their features through a FeatureStore, and
+    this process saves the ones they had to extract, unless it's a dry run.
+
+    Returns a dict of throughput stats for each worker, keyed by pid.
+    '''
+    workers = workers or cpu_count()
+    writer = writer or ResultWriter(dry_run=dry_run)
+    version = MaxentWrapper.load(model_path).get_version()
+    store = use_store and not writer.dry_run and FeatureStore() or None
+
+    # Only the ids are held in memory, packed into a compact array
+    pks = array('l', iter_pks(queryset))
+
+    # Forked workers can't share this process's database connections. Close them
+    # so every process opens its own.
+    for connection in connections.all():
+        connection.close()
+
+    stats = {}
+    pool = Pool(workers, initializer=_init_worker, initargs=(model_path, use_store))
+    try:
+        batches = iter_batches(pks, batch_size)
+        for pid, seconds, scored, entries in pool.imap_unordered(_classify_batch, batches):
+            if store is not None:
+                store.save(entries)
+            for pk, guess, certainty, text_hash in scored:
+                writer.add(pk, guess, certainty, text_hash, version)
+            worker = stats.setdefault(pid, {'batches': 0, 'paragraphs': 0, 'seconds': 0.0})
+            worker['batches'] += 1
+            worker['paragraphs'] += len(scored)
+            worker['seconds'] += seconds
+        writer.close()
+    finally:
+        pool.close()
+        pool.join()
+
+    for worker in stats.values():
+        worker['per_second'] = worker['paragraphs'] / worker['seconds'] if worker['seconds'] else 0.0
+    return stats
@@ -0,0 +1,73 @@
+'''
+predict.py
+
+Scores text on demand against a saved model, for the classify API.
+
+A Predictor loads a saved model once and keeps it, its BatchScorer and a
+feature extractor warm, so scoring a paragraph is just feature extraction and
+one small matrix product, well under a millisecond for typical news paragraphs.
+Each result can also explain itself with the weight every feature added to the
+log-odds of the paragraph being a quote.
+
+get_predictor() returns one Predictor per process and reloads it when the saved
+model file changes, so a web process picks up a newly trained model without
+restarting. Like classify/stream.py, this needs no Django.
+'''
+import os
+import threading
+from classify.features import get_extractor
+from classify.model import MODEL_PATH, load_model
+from classify.scoring import BatchScorer
+
+class Predictor(object):
+    '''
+    A trained classifier ready to score text.
+    '''
+    def __init__(self, classifier, version=None):
+        self.version = version
+        self.scorer = BatchScorer(classifier)
+        self.extractor = get_extractor()
+        self.quote_index = self.scorer.labels.index(True)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        classifier, model = load_model(path)
+        return cls(classifier, model.get('version'))
+
+    def predict(self, texts, explain=True):
+        '''
+        Scores a list of paragraph texts. Returns a dict for each with the guess
+        (quote), its probability (score, as classify saves it), the probability
+        that the paragraph is a quote and, if explain is true, the features
+        behind it as a list of dicts of name, value and weight.
+        '''
+        featuresets = [self.extractor.extract(text) for text in texts]
+        probs = self.scorer.prob_matrix(featuresets) if featuresets else []
+        results = []
+        for featureset, row in zip(featuresets, probs):
+            best = row.argmax()
+            result = {
+                'quote': self.scorer.labels[best],
+                'score': float(row[best]),
+                'probability': float(row[self.quote_index]),
+            }
+            if explain:
+                result['features'] = [{'name': name, 'value': value, 'weight': weight}
+                    for name, value, weight in self.scorer.attributions(featureset)]
+            results.append(result)
+        return results
+
+_predictors = {}
+_predictors_lock = threading.Lock()
+
+def get_predictor(path=MODEL_PATH):
+    '''
+    Returns a Predictor for the model saved at path, shared by this process. It's
+    loaded the first time it's needed and again whenever the file is modified.
+    '''
+    mtime = os.stat(path).st_mtime
+    with _predictors_lock:
+        loaded = _predictors.get(path)
+        if loaded is None or loaded[0] != mtime:
+            loaded = _predictors[path] = (mtime, Predictor.load(path))
+        return loaded[1]
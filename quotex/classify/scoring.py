@@ -0,0 +1,130 @@
+'''
+scoring.py
+
+Vectorized scoring for trained maxent models.
+
+NLTK's prob_classify scores one feature dict at a time by walking the model's
+encoding in pure Python. BatchScorer flattens the same encoding into a weight
+matrix once, encodes a whole batch of feature dicts as a sparse (CSR) matrix of
+feature indices and gets every class probability for the batch from a single
+matrix product in numpy. The results match prob_classify.
+'''
+from itertools import islice
+import numpy
+from classify.instrument import metrics
+
+# Number of paragraphs scored per batch by default
+BATCH_SIZE = 500
+
+########## HELPER FUNCTIONS ##########
+
+def iter_batches(iterable, size=BATCH_SIZE):
+    '''
+    Yields lists of up to size items from any iterable, without loading
+    more than one batch at a time.
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+########## BATCH SCORER ##########
+
+class BatchScorer(object):
+    '''
+    Scores batches of feature dicts against a trained NLTK MaxentClassifier
+    that uses the default binary feature encoding.
+    '''
+    def __init__(self, classifier):
+        encoding = classifier._encoding
+        weights = classifier.weights()
+
+        # Labels are kept in descending order so that argmax breaks ties the
+        # same way NLTK's DictionaryProbDist.max() does.
+        self.labels = sorted(encoding.labels(), reverse=True)
+        label_index = dict((label, i) for i, label in enumerate(self.labels))
+
+        # Every (fname, fval) pair the model knows becomes one column, with one
+        # weight per label. Pairs the model never saw are dropped at encode time,
+        # just like BinaryMaxentFeatureEncoding.encode does.
+        self.columns = {}
+        entries = []
+        for (fname, fval, label), index in encoding._mapping.items():
+            column = self.columns.setdefault((fname, fval), len(self.columns))
+            entries.append((column, label_index[label], weights[index]))
+
+        self.weights = numpy.zeros((len(self.columns), len(self.labels)))
+        for column, label, weight in entries:
+            self.weights[column, label] = weight
+
+    def encode(self, featuresets):
+        '''
+        Encodes a list of feature dicts as the index pointer and column index
+        arrays of a CSR matrix. All feature values are binary, so no data array
+        is needed.
+        '''
+        columns = self.columns
+        indices, indptr = [], [0]
+        for featureset in featuresets:
+            for item in featureset.iteritems():
+                column = columns.get(item)
+                if column is not None:
+                    indices.append(column)
+            indptr.append(len(indices))
+        return numpy.array(indptr, dtype=int), numpy.array(indices, dtype=int)
+
+    def prob_matrix(self, featuresets):
+        '''
+        Returns an array of class probabilities with one row per feature dict
+        and one column per label in self.labels.
+        '''
+        n = len(featuresets)
+        indptr, indices = self.encode(featuresets)
+
+        # Sparse-times-dense product: sum the weight rows of each dict's features
+        scores = numpy.zeros((n, len(self.labels)))
+        if len(indices):
+            rows = numpy.repeat(numpy.arange(n), numpy.diff(indptr))
+            row_weights = self.weights[indices]
+            for j in range(len(self.labels)):
+                scores[:, j] = numpy.bincount(rows, weights=row_weights[:, j], minlength=n)
+
+        # NLTK treats the summed weights as base-2 log probabilities
+        scores -= scores.max(axis=1)[:, numpy.newaxis]
+        probs = numpy.power(2.0, scores)
+        probs /= probs.sum(axis=1)[:, numpy.newaxis]
+        return probs
+
+    def score(self, featuresets):
+        '''
+        Returns a (guess, certainty) pair for each feature dict, where guess is the
+        most probable label and certainty is its probability. Same as calling
+        prob_classify on each dict and taking max() and prob(max()).
+        '''
+        if not featuresets:
+            return []
+        with metrics.timer('score'):
+            probs = self.prob_matrix(featuresets)
+            best = probs.argmax(axis=1)
+            return [(self.labels[j], float(probs[i, j])) for i, j in enumerate(best)]
+
+    def attributions(self, featureset, label=True):
+        '''
+        Returns a (name, value, weight) triple for each feature in a dict that the
+        model knows, largest effect first. weight is how much the feature adds to
+        the log-odds (base 2) of label, against the mean of the other labels. With
+        two labels, the weights add up to the log-odds of label.
+        '''
+        j = self.labels.index(label)
+        others = [i for i in range(len(self.labels)) if i != j]
+        result = []
+        for item in featureset.iteritems():
+            column = self.columns.get(item)
+            if column is not None:
+                row = self.weights[column]
+                weight = row[j] - (row[others].mean() if others else 0.0)
+                result.append((item[0], item[1], float(weight)))
+        result.sort(key=lambda triple: -abs(triple[2]))
+        return result
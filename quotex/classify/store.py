@@ -0,0 +1,95 @@
+'''
+store.py
+
+Persistent cache of extracted features. FeatureStore keeps each paragraph's
+feature dict in the FeatureSet table, and only reuses it while the paragraph's
+text hash and the feature version still match.
+'''
+import json
+from django.db import transaction
+from quotex.apps.content.models import FeatureSet, hash_text
+from classify.constants import FEATURE_VERSION
+from classify.corpus import ID_BATCH_SIZE, MAX_QUERY_PARAMS
+from classify.features import get_extractor
+from classify.instrument import metrics
+
+# Rows per INSERT. bulk_create in Django 1.4 puts every row in one statement,
+# and each row takes four parameters.
+INSERT_BATCH_SIZE = MAX_QUERY_PARAMS / 4
+
+########## FEATURE STORE ##########
+
+class FeatureStore(object):
+    '''
+    Looks up features for paragraphs in the FeatureSet table, extracting and
+    storing them for paragraphs that aren't cached or whose entry is stale.
+    A readonly store never writes, for dry runs.
+    '''
+    def __init__(self, extract=None, readonly=False):
+        self.extract = extract or get_extractor().extract
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+
+    def get_features(self, items, save=True):
+        '''
+        Takes a list of Paragraphs or ParagraphRows and returns their feature
+        dicts, in the same order. New and replaced entries are saved unless save
+        is False.
+        '''
+        features, entries = self.lookup(items)
+        if save:
+            self.save(entries)
+        return features
+
+    def lookup(self, items):
+        '''
+        Like get_features, but saves nothing. Returns the feature dicts and a
+        list of the FeatureSet entries that are missing or stale, for save().
+        '''
+        hashes = [hash_text(item.text) for item in items]
+        with metrics.timer('store.fetch'):
+            stored = self._fetch([item.pk for item in items if item.pk is not None])
+
+        features, missing = [], {}
+        for item, text_hash in zip(items, hashes):
+            entry = stored.get(item.pk)
+            if entry is not None and entry[0] == text_hash and entry[1] == FEATURE_VERSION:
+                self.hits += 1
+                metrics.count('store_hits')
+                features.append(json.loads(entry[2]))
+            else:
+                self.misses += 1
+                metrics.count('store_misses')
+                featureset = self.extract(item.text)
+                features.append(featureset)
+                if item.pk is not None:
+                    missing[item.pk] = FeatureSet(paragraph_id=item.pk, text_hash=text_hash,
+                        feature_version=FEATURE_VERSION, features=json.dumps(featureset))
+        return features, missing.values()
+
+    def save(self, entries):
+        '''
+        Saves FeatureSet entries from lookup(), replacing any stored for the
+        same paragraphs.
+        '''
+        if entries and not self.readonly:
+            with metrics.timer('store.write'):
+                self._store(entries)
+
+    def _fetch(self, pks):
+        stored = {}
+        for start in range(0, len(pks), ID_BATCH_SIZE):
+            rows = FeatureSet.objects.filter(paragraph__in=pks[start:start + ID_BATCH_SIZE]) \
+                .values_list('paragraph', 'text_hash', 'feature_version', 'features')
+            for pk, text_hash, feature_version, features in rows:
+                stored[pk] = (text_hash, feature_version, features)
+        return stored
+
+    def _store(self, entries):
+        with transaction.commit_on_success():
+            pks = [entry.paragraph_id for entry in entries]
+            for start in range(0, len(pks), ID_BATCH_SIZE):
+                FeatureSet.objects.filter(paragraph__in=pks[start:start + ID_BATCH_SIZE]).delete()
+            for start in range(0, len(entries), INSERT_BATCH_SIZE):
+                FeatureSet.objects.bulk_create(entries[start:start + INSERT_BATCH_SIZE])
@@ -0,0 +1,133 @@
+'''
+stream.py
+
+Classifies paragraphs streamed as JSON lines, without Django or a database.
+
+Each input line is a JSON object with an id and the text of a paragraph. Each
+output line has the same id, whether the paragraph is a quote and the
+probability of that guess, just like the quote and score fields classify saves:
+
+    {"id": 17, "text": "\\"It's a good day,\\" Lee said."}
+    {"id": 17, "quote": true, "score": 0.97}
+
+The id can be any JSON value and is passed through untouched. Paragraphs are
+read, scored and written batch_size at a time, so memory use stays the same
+however long the input is. Only NLTK and numpy are needed, plus a model saved
+by MaxentWrapper.save, so this runs on machines with no database access.
+
+Usage, from the quotex directory:
+
+    python -m classify.stream [--model=path] [--batch-size=n] [file ...] < in.jsonl > out.jsonl
+
+Input is read from the named files, which can be gzipped, or from stdin if
+there are none. Lines that aren't valid are reported on stderr and skipped,
+unless --strict is given, and the exit status is 1 if any were.
+'''
+import gzip
+import json
+import sys
+from optparse import OptionParser
+from classify.features import get_extractor
+from classify.model import MODEL_PATH, load_model
+from classify.scoring import BATCH_SIZE, BatchScorer, iter_batches
+
+########## READING ##########
+
+class InvalidRecord(ValueError):
+    '''
+    Raised for an input line that isn't a paragraph record, when not skipping them.
+    '''
+
+def open_input(path):
+    '''
+    Opens a file for reading, decompressing it if its name ends in .gz. A path
+    of "-" means stdin.
+    '''
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def iter_records(f, name='<stdin>', on_error=None):
+    '''
+    Yields an (id, text) pair for every line of a JSON lines file. Blank lines are
+    skipped. For lines that aren't an object with an id and a text string, calls
+    on_error with a message, or raises InvalidRecord if on_error is None.
+    '''
+    for lineno, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError, e:
+            record, problem = None, 'invalid JSON (%s)' % e
+        else:
+            if not isinstance(record, dict) or 'id' not in record:
+                problem = 'expected an object with an id'
+            elif not isinstance(record.get('text'), basestring):
+                problem = 'expected a text string'
+            else:
+                yield record['id'], record['text']
+                continue
+        message = '%s:%s: %s' % (name, lineno, problem)
+        if on_error is None:
+            raise InvalidRecord(message)
+        on_error(message)
+
+########## CLASSIFYING ##########
+
+def classify_stream(records, classifier, batch_size=BATCH_SIZE):
+    '''
+    Takes an iterable of (id, text) pairs and a trained classifier and yields a
+    dict of id, quote and score for each, scoring batch_size at a time.
+    '''
+    scorer, extractor = BatchScorer(classifier), get_extractor()
+    for batch in iter_batches(records, batch_size):
+        results = scorer.score([extractor.extract(text) for pk, text in batch])
+        for (pk, text), (guess, certainty) in zip(batch, results):
+            yield {'id': pk, 'quote': guess, 'score': certainty}
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [file ...]')
+    parser.add_option('--model', dest='model', default=MODEL_PATH,
+        help='Path of the saved model. Defaults to %s' % MODEL_PATH)
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=BATCH_SIZE,
+        help='Paragraphs scored at a time. Defaults to %s.' % BATCH_SIZE)
+    parser.add_option('--strict', dest='strict', action='store_true', default=False,
+        help='Stop at the first invalid line instead of skipping it.')
+    options, args = parser.parse_args(argv)
+
+    classifier, model = load_model(options.model)
+    errors = []
+    def on_error(message):
+        errors.append(message)
+        print >> sys.stderr, 'Skipped %s' % message
+
+    def records():
+        for path in args or ['-']:
+            f = open_input(path)
+            try:
+                for record in iter_records(f, path == '-' and '<stdin>' or path,
+                        on_error=not options.strict and on_error or None):
+                    yield record
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+
+    out = sys.stdout
+    try:
+        for i, result in enumerate(classify_stream(records(), classifier, options.batch_size), 1):
+            out.write(json.dumps(result) + '\n')
+            if i % options.batch_size == 0:
+                out.flush() # Let the next command in a pipeline start on each batch
+    except InvalidRecord, e:
+        print >> sys.stderr, e
+        return 1
+    out.flush()
+    return errors and 1 or 0
+
+########## MAIN ##########
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+'''
+train.py
+
+Numpy training backend for maxent models.
+
+NLTK's IIS trainer is pure Python and runs for a fixed number of iterations. train_lbfgs fits the same kind of model, with the same binary
+feature encoding, by maximizing the log-likelihood with L-BFGS over a sparse
+design matrix in numpy. It stops when the objective converges, can warm-start
+from an earlier model and reports the log-likelihood and time of every
+iteration. It returns an ordinary NLTK MaxentClassifier, so the trained model
+can be saved, loaded and scored like one trained by NLTK.
+
+A Gaussian prior (L2 penalty) on the weights keeps them finite on training
+sets the features separate perfectly, which is common with small labeled sets.
+'''
+import math
+import time
+import numpy
+from nltk.classify import MaxentClassifier
+from nltk.classify.maxent import BinaryMaxentFeatureEncoding
+
+# NLTK treats weights as base-2 log probabilities, while the objective below
+# uses natural logs. Weights are divided by this when handed back to NLTK.
+LN2 = math.log(2)
+
+# Defaults for train_lbfgs
+MAX_ITER = 100
+TOLERANCE = 1e-5
+SIGMA = 1.0
+MEMORY = 10
+
+# Iterations IIS runs for when max_iter isn't given
+NLTK_MAX_ITER = 10
+
+# Algorithms train_classifier accepts. Both give models with the binary feature
+# encoding that BatchScorer and saved models assume. NLTK's GIS adds a
+# correction feature, so it isn't one of them.
+ALGORITHMS = ('iis', 'lbfgs')
+
+########## HELPER FUNCTIONS ##########
+
+def _bincount(x, weights, minlength):
+    '''
+    numpy.bincount that also accepts empty input.
+    '''
+    if not len(x):
+        return numpy.zeros(minlength)
+    return numpy.bincount(x, weights=weights, minlength=minlength)
+
+########## DESIGN MATRIX ##########
+
+class DesignMatrix(object):
+    '''
+    Sparse design matrix for a training set: for each label, the weight indices
+    that fire for each training token when it is given that label, stored as
+    parallel arrays of row numbers and weight indices.
+    '''
+    def __init__(self, encoding, train_toks):
+        self.labels = list(encoding.labels())
+        self.n = len(train_toks)
+        self.d = encoding.length()
+        label_index = dict((label, k) for k, label in enumerate(self.labels))
+        self.y = numpy.array([label_index[label] for featureset, label in train_toks], dtype=int)
+
+        self.rows, self.cols = [], []
+        for label in self.labels:
+            rows, cols = [], []
+            for i, (featureset, gold) in enumerate(train_toks):
+                for index, value in encoding.encode(featureset, label):
+                    rows.append(i)
+                    cols.append(index)
+            self.rows.append(numpy.array(rows, dtype=int))
+            self.cols.append(numpy.array(cols, dtype=int))
+
+        # Feature counts observed with the true labels. Constant across iterations.
+        self.empirical = numpy.zeros(self.d)
+        for k in range(len(self.labels)):
+            gold = self.y[self.rows[k]] == k
+            self.empirical += _bincount(self.cols[k][gold], None, self.d)
+
+    def objective(self, weights, sigma):
+        '''
+        Returns the negative penalized log-likelihood of the training set under
+        the given (natural log) weights, its gradient and the mean log-likelihood.
+        '''
+        scores = numpy.zeros((self.n, len(self.labels)))
+        for k in range(len(self.labels)):
+            scores[:, k] = _bincount(self.rows[k], weights[self.cols[k]], self.n)
+
+        top = scores.max(axis=1)
+        log_z = top + numpy.log(numpy.exp(scores - top[:, numpy.newaxis]).sum(axis=1))
+        log_likelihood = scores[numpy.arange(self.n), self.y].sum() - log_z.sum()
+
+        probs = numpy.exp(scores - log_z[:, numpy.newaxis])
+        expected = numpy.zeros(self.d)
+        for k in range(len(self.labels)):
+            expected += _bincount(self.cols[k], probs[self.rows[k], k], self.d)
+
+        value = -log_likelihood
+        gradient = expected - self.empirical
+        if sigma:
+            value += weights.dot(weights) / (2 * sigma ** 2)
+            gradient += weights / sigma ** 2
+        return value, gradient, log_likelihood / max(self.n, 1)
+
+########## TRAINING ##########
+
+def get_max_iter(algo, max_iter=None):
+    '''
+    Returns the number of iterations train_classifier runs algo for, given the
+    max_iter it was passed.
+    '''
+    if max_iter is not None:
+        return max_iter
+    return algo == 'lbfgs' and MAX_ITER or NLTK_MAX_ITER
+
+def train_classifier(train_set, algo='iis', trace=0, max_iter=None, warm_start=None, **options):
+    '''
+    Trains a maxent classifier on a list of (featureset, label) pairs. Returns the
+    classifier and, for lbfgs, its per-iteration log-likelihood and timings.
+
+    algo is 'iis' for NLTK's trainer, which runs for max_iter iterations (10 by
+    default), or 'lbfgs' for the much faster numpy trainer below, which stops once
+    it converges or after max_iter iterations (100 by default). lbfgs also accepts
+    a trained MaxentClassifier to start from as warm_start, and the tolerance and
+    sigma options of train_lbfgs.
+    '''
+    if algo not in ALGORITHMS:
+        raise ValueError('Unsupported training algorithm %r. Use one of: %s' % (algo, ', '.join(ALGORITHMS)))
+    max_iter = get_max_iter(algo, max_iter)
+    if algo == 'lbfgs':
+        return train_lbfgs(train_set, max_iter=max_iter, trace=trace, warm_start=warm_start, **options)
+    if warm_start is not None:
+        raise ValueError('warm_start is only supported by the lbfgs algorithm')
+    return MaxentClassifier.train(train_set, algorithm=algo, trace=trace, max_iter=max_iter, **options), None
+
+def train_lbfgs(train_toks, labels=None, max_iter=MAX_ITER, tolerance=TOLERANCE, sigma=SIGMA,
+    memory=MEMORY, warm_start=None, trace=0):
+    '''
+    Trains a MaxentClassifier with L-BFGS. Takes (featureset, label) pairs like
+    MaxentClassifier.train.
+
+    Training stops after max_iter iterations or once an iteration changes the
+    objective by less than tolerance (relative). sigma is the standard deviation
+    of the Gaussian prior on the weights; 0 turns the prior off. memory is the
+    number of past steps L-BFGS uses to approximate the curvature. warm_start
+    is an already trained MaxentClassifier whose weights are used as the
+    starting point for every feature both models share.
+
+    Returns the classifier and a list with the iteration number, mean
+    log-likelihood and elapsed seconds of each iteration.
+    '''
+    encoding = BinaryMaxentFeatureEncoding.train(train_toks, labels=labels)
+    design = DesignMatrix(encoding, train_toks)
+
+    weights = numpy.zeros(design.d)
+    if warm_start is not None:
+        old_weights = warm_start.weights()
+        for key, index in warm_start._encoding._mapping.items():
+            new_index = encoding._mapping.get(key)
+            if new_index is not None:
+                weights[new_index] = old_weights[index] * LN2
+
+    history = []
+    start = time.time()
+    if trace:
+        print '      Iteration    Log Likelihood    Seconds'
+        print '      ---------------------------------------'
+
+    value, gradient, log_likelihood = design.objective(weights, sigma)
+    steps = []
+    for iteration in range(1, max_iter + 1):
+        # Two-loop recursion: direction = -(approximate inverse Hessian) * gradient
+        direction = -gradient
+        alphas = []
+        for s, y, rho in reversed(steps):
+            alpha = rho * s.dot(direction)
+            direction = direction - alpha * y
+            alphas.append(alpha)
+        if steps:
+            s, y, rho = steps[-1]
+            direction *= s.dot(y) / y.dot(y)
+        for (s, y, rho), alpha in zip(steps, reversed(alphas)):
+            beta = rho * y.dot(direction)
+            direction = direction + (alpha - beta) * s
+
+        slope = gradient.dot(direction)
+        if slope >= 0:
+            # Not a descent direction. Start over from steepest descent.
+            steps = []
+            direction = -gradient
+            slope = -gradient.dot(gradient)
+
+        # Backtracking line search for sufficient decrease
+        step = 1.0 if steps else 1.0 / max(math.sqrt(-slope), 1.0)
+        while True:
+            new_weights = weights + step * direction
+            new_value, new_gradient, log_likelihood = design.objective(new_weights, sigma)
+            if new_value <= value + 1e-4 * step * slope or step < 1e-10:
+                break
+            step *= 0.5
+
+        s, y = new_weights - weights, new_gradient - gradient
+        if s.dot(y) > 1e-10:
+            steps.append((s, y, 1.0 / s.dot(y)))
+            if len(steps) > memory:
+                steps.pop(0)
+
+        converged = abs(value - new_value) <= tolerance * max(abs(new_value), 1.0)
+        weights, value, gradient = new_weights, new_value, new_gradient
+
+        seconds = time.time() - start
+        history.append({'iteration': iteration, 'log_likelihood': log_likelihood, 'seconds': seconds})
+        if trace:
+            print '     %9d    %14.5f    %7.3f' % (iteration, log_likelihood, seconds)
+        if converged:
+            break
+
+    return MaxentClassifier(encoding, weights / LN2), history
@@ -0,0 +1,171 @@
+'''
+writer.py
+
+Buffered write-back of classification results. ResultWriter updates Paragraphs
+in chunks, one transaction per chunk, and adjusts the Counter totals to match.
+In dry-run mode it prints each result as a line of JSON instead.
+'''
+import json
+import sys
+from cStringIO import StringIO
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from quotex.apps.content.models import Counter, Paragraph
+from classify.corpus import ID_BATCH_SIZE, MAX_QUERY_PARAMS
+from classify.instrument import metrics
+
+# Number of results buffered before they are written in one transaction
+WRITE_CHUNK_SIZE = 1000
+
+########## RESULT WRITER ##########
+
+class ResultWriter(object):
+    '''
+    Collects classification results and writes them to the Paragraph table in
+    bulk. Call add() for each result and close() when done, or use it as a
+    context manager.
+    '''
+    fields = ('quote', 'score', 'text_hash', 'model_version')
+
+    def __init__(self, chunk_size=WRITE_CHUNK_SIZE, dry_run=False, stream=None, using=DEFAULT_DB_ALIAS):
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.stream = stream or sys.stdout
+        self.using = using
+        self.buffer = []
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def add(self, pk, quote, score, text_hash='', model_version=''):
+        '''
+        Buffer one result, flushing the buffer if it is full. text_hash and
+        model_version should be the hash of the text that was scored and the
+        version of the model that scored it.
+        '''
+        self.buffer.append((pk, quote, score, text_hash, model_version))
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write out everything in the buffer.
+        '''
+        if not self.buffer:
+            return
+        rows, self.buffer = self.buffer, []
+        with metrics.timer('write'):
+            if self.dry_run:
+                self._emit(rows)
+            else:
+                connection = connections[self.using]
+                with transaction.commit_on_success(using=self.using):
+                    deltas = self._count_changes(rows)
+                    if connection.vendor == 'postgresql':
+                        self._copy_update(connection, rows)
+                    else:
+                        self._case_update(connection, rows)
+                    # Bulk updates skip Paragraph.save, so the Counters are adjusted here
+                    if deltas is not None:
+                        Counter.adjust(**deltas)
+                        if not deltas['quotes']:
+                            Counter.bump('quotes_version') # As many quotes as before, but not the same ones
+        metrics.count('results_written', len(rows))
+        self.written += len(rows)
+
+    def close(self):
+        '''
+        Flush any remaining results.
+        '''
+        self.flush()
+
+    def _count_changes(self, rows):
+        '''
+        Returns the change the rows make to the quote and quoted word totals, as
+        keyword arguments for Counter.adjust, or None if no paragraph becomes or
+        stops being a quote. Reads the rows' old values a batch at a time.
+        '''
+        deltas, changed = {'quotes': 0, 'quoted_words': 0}, False
+        quotes = dict((row[0], row[1] is True) for row in rows)
+        pks = quotes.keys()
+        for start in range(0, len(pks), ID_BATCH_SIZE):
+            old = Paragraph.objects.using(self.using).filter(pk__in=pks[start:start + ID_BATCH_SIZE]) \
+                .values_list('pk', 'quote', 'num_words')
+            for pk, was_quote, num_words in old:
+                change = quotes[pk] - (was_quote is True)
+                if change:
+                    deltas['quotes'] += change
+                    deltas['quoted_words'] += change * (num_words or 0)
+                    changed = True
+        return changed and deltas or None
+
+    def _emit(self, rows):
+        for pk, quote, score, text_hash, model_version in rows:
+            self.stream.write(json.dumps({'id': pk, 'quote': quote, 'score': score}) + '\n')
+
+    def _case_update(self, connection, rows):
+        '''
+        UPDATE ... SET col = CASE id WHEN ... END for a batch of rows at a time.
+        Works on any backend.
+        '''
+        qn = connection.ops.quote_name
+        table = qn(Paragraph._meta.db_table)
+        pk = qn(Paragraph._meta.pk.column)
+        columns = [qn(Paragraph._meta.get_field(f).column) for f in self.fields]
+        cursor = connection.cursor()
+
+        # Each row needs a pk and value per column, plus its pk in the IN clause
+        batch_size = MAX_QUERY_PARAMS / (2 * len(columns) + 1)
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cases = ' '.join(['WHEN %s THEN %s'] * len(batch))
+            sets = ', '.join(['%s = CASE %s %s END' % (column, pk, cases) for column in columns])
+            sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (table, sets, pk, ', '.join(['%s'] * len(batch)))
+            params = []
+            for i in range(len(columns)):
+                for row in batch:
+                    params.extend((row[0], row[i + 1]))
+            params.extend(row[0] for row in batch)
+            cursor.execute(sql, params)
+
+    def _copy_update(self, connection, rows):
+        '''
+        COPY the rows into a temporary table and update from it with a join.
+        PostgreSQL only.
+        '''
+        qn = connection.ops.quote_name
+        table = qn(Paragraph._meta.db_table)
+        pk = qn(Paragraph._meta.pk.column)
+        columns = [Paragraph._meta.get_field(f).column for f in self.fields]
+        cursor = connection.cursor()
+        cursor.execute('CREATE TEMPORARY TABLE quotex_results (id integer, %s) ON COMMIT DROP' % ', '.join(
+            '%s %s' % (qn(c), Paragraph._meta.get_field(f).db_type(connection=connection))
+            for f, c in zip(self.fields, columns)))
+
+        data = StringIO()
+        for row in rows:
+            data.write('\t'.join(_copy_value(v) for v in row) + '\n')
+        data.seek(0)
+        cursor.copy_from(data, 'quotex_results', columns=['id'] + columns)
+
+        cursor.execute('UPDATE %s SET %s FROM quotex_results WHERE %s.%s = quotex_results.id' % (
+            table, ', '.join('%s = quotex_results.%s' % (qn(c), qn(c)) for c in columns), table, pk))
+
+########## HELPER FUNCTIONS ##########
+
+def _copy_value(value):
+    '''
+    Formats a value for PostgreSQL's COPY text format.
+    '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return value and 't' or 'f'
+    if isinstance(value, float):
+        return repr(value)
+    value = unicode(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+    return value.encode('utf-8')
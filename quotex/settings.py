@@ -1,11 +1,16 @@
 import logging
 import os
+import sys
 import django
 
 # Base paths
 DJANGO_ROOT = os.path.dirname(os.path.realpath(django.__file__))
 SITE_ROOT = os.path.dirname(os.path.realpath(__file__))
 
+# The classify and bin packages are imported as top-level packages
+if SITE_ROOT not in sys.path:
+    sys.path.insert(0, SITE_ROOT)
+
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
 
@@ -137,7 +142,17 @@ CACHE_MIDDLEWARE_SECONDS = 3 # 3 seconds
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache'
-    }
+    },
+    # Site stats only (see apps/content/stats.py). File-based, so stats invalidated
+    # by management commands (classify, coref) are seen by the web server processes
+    # too. It only ever holds a few keys, so it never gets near MAX_ENTRIES and culls.
+    'stats': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(SITE_ROOT, 'data/cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
 }
 
 # A sample logging configuration. The only tangible logging
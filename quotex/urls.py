@@ -1,7 +1,7 @@
 from django.conf.urls import patterns, include, url
 from tastypie.api import Api
 from quotex.apps.content.views import IndexView
-from quotex.apps.content.api import QuoteResource, SourceResource
+from quotex.apps.content.api import ClassifyResource, QuoteResource, SourceResource
 
 # Uncomment the next two lines to enable the admin:
 from django.contrib import admin
@@ -11,6 +11,7 @@ admin.autodiscover()
 v1_api = Api(api_name='v1')
 v1_api.register(QuoteResource())
 v1_api.register(SourceResource())
+v1_api.register(ClassifyResource())
 
 urlpatterns = patterns('',
     # Examples:
@@ -0,0 +1,171 @@
+'''
+ingest.py
+
+Batch ingestion of stories into Paragraph rows.
+
+Stories come from JSON lines or CSV files, or from Story rows already in the
+database that haven't been split into paragraphs yet. Each story's body has
+its HTML stripped and unescaped and its smart quotes converted (see
+clean_quotes.py). It is then split into ordered paragraphs, one per non-blank
+line as in the bundled corpus, with <br> and closing block tags also ending a
+paragraph. Each paragraph gets its num_words.
+
+That work is pure Python and CPU-bound, so with workers > 1 it runs in a pool
+of worker processes, a batch of stories at a time. Only a few batches are in
+flight at once, so memory stays flat however big the input is. The parent
+process does all the writing: one transaction per batch, with paragraphs
+inserted by bulk_create.
+'''
+import csv
+import HTMLParser
+import json
+import re
+import sys
+import time
+from collections import deque
+from multiprocessing import Pool
+from django.db import connections, reset_queries, transaction
+from django.utils.html import strip_tags
+from quotex.apps.content.models import Paragraph, Story, count_quoted_words
+from quotex.utils.clean_quotes import convert_smart_quotes
+from classify.corpus import MAX_QUERY_PARAMS, iter_keyset
+from classify.scoring import iter_batches
+
+# Stories prepared and written per batch
+CHUNK_SIZE = 100
+
+# Rows per INSERT. bulk_create in Django 1.4 puts every row in one statement,
+# and each paragraph takes nine parameters.
+INSERT_BATCH_SIZE = MAX_QUERY_PARAMS / 9
+
+# Story fields read from input files
+STORY_FIELDS = ('title', 'slug', 'body', 'url')
+
+# Closing block tags, which end a paragraph even without a line break after them
+BLOCK_END_RE = re.compile(r'</(?:p|div|h[1-6]|li|blockquote)\s*>|<br\s*/?>', re.IGNORECASE)
+
+########## TEXT PROCESSING ##########
+
+def clean_body(body):
+    '''
+    Returns a story body as plain text, with HTML tags stripped, entities
+    unescaped and smart quotes converted to plain ones.
+    '''
+    text = strip_tags(BLOCK_END_RE.sub(lambda m: m.group() + '\n', body))
+    return convert_smart_quotes(HTMLParser.HTMLParser().unescape(text))
+
+def split_paragraphs(text):
+    '''
+    Splits plain text into paragraphs, one per non-blank line.
+    '''
+    return [line.strip() for line in text.split('\n') if line.strip()]
+
+def prepare_story(story):
+    '''
+    Takes a story dict and returns it along with a list of (order, text,
+    num_words) for each of its paragraphs.
+    '''
+    paragraphs = split_paragraphs(clean_body(story.get('body') or u''))
+    return story, [(order, text, count_quoted_words(text)) for order, text in enumerate(paragraphs)]
+
+def _prepare_batch(stories):
+    return [prepare_story(story) for story in stories]
+
+########## READERS ##########
+
+def read_jsonl(path):
+    '''
+    Yields a story dict for each line of a JSON lines file.
+    '''
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield dict((field, record.get(field) or u'') for field in STORY_FIELDS)
+
+def read_csv(path):
+    '''
+    Yields a story dict for each row of a UTF-8 CSV file with a header row.
+    '''
+    csv.field_size_limit(sys.maxsize) # Story bodies can be longer than the default limit
+    with open(path, 'rb') as f:
+        for record in csv.DictReader(f):
+            yield dict((field, (record.get(field) or '').decode('utf-8')) for field in STORY_FIELDS)
+
+def unsplit_stories(queryset=None, chunk_size=CHUNK_SIZE):
+    '''
+    Yields a story dict, including its pk, for every story in the database that
+    has no paragraphs yet. Walks the stories in pk order a chunk at a time.
+    '''
+    queryset = (queryset if queryset is not None else Story.objects.all()).filter(paragraph__isnull=True)
+    for rows in iter_keyset(queryset.values('pk', *STORY_FIELDS), chunk_size=chunk_size):
+        for row in rows:
+            yield row
+
+########## WRITING ##########
+
+def _write_batch(prepared):
+    '''
+    Saves a batch of prepared stories and their paragraphs in one transaction.
+    Stories that came from the database already have a pk and are not saved again.
+    Returns the number of paragraphs written.
+    '''
+    paragraphs = []
+    with transaction.commit_on_success():
+        for story, texts in prepared:
+            pk = story.get('pk')
+            if pk is None:
+                pk = Story.objects.create(**dict((field, story[field]) for field in STORY_FIELDS)).pk
+            paragraphs.extend(Paragraph(story_id=pk, order=order, text=text, num_words=num_words)
+                for order, text, num_words in texts)
+        for start in range(0, len(paragraphs), INSERT_BATCH_SIZE):
+            Paragraph.objects.bulk_create(paragraphs[start:start + INSERT_BATCH_SIZE])
+    reset_queries()
+    return len(paragraphs)
+
+########## PUBLIC FUNCTIONS ##########
+
+def ingest(stories, workers=1, chunk_size=CHUNK_SIZE, progress=None):
+    '''
+    Splits an iterable of story dicts into paragraphs and saves them. Dicts with
+    a pk are existing stories; the rest are saved as new stories. With workers
+    > 1, stories are prepared in that many worker processes while this one
+    writes. progress, if given, is called with the running stats after every
+    batch.
+
+    Returns a dict with the number of stories and paragraphs written and the
+    seconds taken.
+    '''
+    stats = {'stories': 0, 'paragraphs': 0, 'seconds': 0.0}
+    start = time.time()
+
+    def write(prepared):
+        stats['paragraphs'] += _write_batch(prepared)
+        stats['stories'] += len(prepared)
+        stats['seconds'] = time.time() - start
+        if progress is not None:
+            progress(stats)
+
+    if workers <= 1:
+        for batch in iter_batches(stories, chunk_size):
+            write(_prepare_batch(batch))
+        return stats
+
+    # Forked workers can't share this process's database connections
+    for connection in connections.all():
+        connection.close()
+
+    pool = Pool(workers)
+    try:
+        # Keep a couple of batches per worker in flight, written in input order
+        pending = deque()
+        for batch in iter_batches(stories, chunk_size):
+            pending.append(pool.apply_async(_prepare_batch, (batch,)))
+            if len(pending) > workers * 2:
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    return stats